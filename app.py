@@ -1,87 +1,146 @@
 import asyncio
-import threading
+import json
+import time
 
+# Taken before the imports below, which load numpy, zmq and pyaudio
+boot_start = time.perf_counter()
+
+from arbitration import Arbiter
 from audio import Audio
 from client import Client
+from codec import Uplink
 from commands import Command
+from echo import EchoCanceller, Reference, ECHO_CANCEL
+from response import ResponseStream
+from session import Session
 from runner import PreciseRunner
 from config import config
-from udp_discovery import udp_listener, udp_broadcast
+from tracing import tracer
+from udp_discovery import Discovery
+import logger
+
+log = logger.get(__name__)
 
 main_loop = asyncio.get_event_loop()
 audio = Audio()
-client = Client(config.get('ZEROMQ_ROUTER_HOST'), config.get('NAME'))
+uplink = Uplink(config.get('UPLINK_CODEC', 'pcm16'), int(config.get('UPLINK_BATCH', 1)))
+client = Client(config.get('ZEROMQ_ROUTER_HOST'), config.get('NAME'), uplink.greeting())
+session = Session(client)
+response = ResponseStream(audio)
+echo = EchoCanceller(Reference()) if ECHO_CANCEL else None
+if echo:
+    audio.reference = echo.reference
+arbiter = Arbiter(config.get('NAME'), client.publish, peers=lambda: len(discovery.peers))
+
+
+async def claim_activation(wake_word, claim):
+    if not await arbiter.resolve(claim):
+        # cancel() skips on_finish_phrase, which would otherwise finish the claim
+        runner.cancel()
+        arbiter.finish()
+        return
+    await client.publish('request mute')
+    audio.play_file_async('sounds/click.wav')
+    params = json.dumps({'wake_word': wake_word}).encode()
+    await session.send(Command.START_SPEAK.value, params)
 
 
-def on_activation():
-    asyncio.run_coroutine_threadsafe(client.publish('request mute'), main_loop)
-    audio.play_file_async('sounds/click.wav')
-    asyncio.run_coroutine_threadsafe(client.send(Command.START_SPEAK.value, b''), main_loop)
+async def barge_in():
+    params = response.interrupt()
+    if params is not None:
+        await session.send(Command.CLEAR.value, params)
+
+
+def on_activation(wake_word):
+    claim = arbiter.begin(runner.activation_score, runner.activation_energy)
+    # Scheduled first, so CLEAR is queued before START_SPEAK
+    asyncio.run_coroutine_threadsafe(barge_in(), main_loop)
+    asyncio.run_coroutine_threadsafe(claim_activation(wake_word, claim), main_loop)
 
 
 def on_listen_phrase(chunk):
-    # print('on_listen_phrase')
-    asyncio.run_coroutine_threadsafe(client.send(Command.CONTINUE.value, chunk), main_loop)
+    # One CONTINUE per uplink batch, also for the audio held during arbitration,
+    # so every message has the layout announced in GREET
+    for held in arbiter.hold(chunk):
+        packets = uplink.push(held)
+        if packets:
+            asyncio.run_coroutine_threadsafe(session.send(Command.CONTINUE.value, *packets), main_loop)
 
 
 def on_finish_phrase(speech_detected, data):
-    print(f'speech_detected: {speech_detected}')
+    log.info('Finished listening', extra=logger.fields(speech_detected=speech_detected))
+    owned = arbiter.owns_listen
+    arbiter.finish()
+    if not owned:
+        uplink.reset()
+        return
     asyncio.run_coroutine_threadsafe(client.publish('request unmute'), main_loop)
     if speech_detected:
-        asyncio.run_coroutine_threadsafe(client.send(Command.FINISH.value, b''), main_loop)
+        packets = uplink.flush()
+        if packets:
+            asyncio.run_coroutine_threadsafe(session.send(Command.CONTINUE.value, *packets), main_loop)
+        asyncio.run_coroutine_threadsafe(session.send(Command.FINISH.value, b''), main_loop)
+        main_loop.call_soon_threadsafe(response.expect)
     else:
-        asyncio.run_coroutine_threadsafe(client.send(Command.CANCEL.value, b''), main_loop)
+        uplink.reset()
+        asyncio.run_coroutine_threadsafe(session.send(Command.CANCEL.value, b''), main_loop)
 
 
 def on_receive_data(tag, params, frame):
     if tag == 'SPEAK':
-        audio.play(frame)
+        response.on_speak(params, frame)
 
     if tag == 'INIT_CONVERSATION':
         audio.play_file_async('sounds/success-bell.wav')
 
     if tag == 'WAKEUP':
+        arbiter.accept()
         runner.wake_up(params['wait_timeout'])
 
 
-def on_peer_message(message):
+def on_peer_message(message, payload=None):
     if message == 'mute':
         runner.mute()
     if message == 'unmute':
         runner.un_mute()
+    if message == 'claim':
+        arbiter.on_claim(json.loads(payload))
 
 
-queue = asyncio.Queue()
-
-
-async def udp_consumer():
-    while True:
-        msg = await queue.get()
-        print(f'Message from queue: {msg}')
-        await client.subscribe(msg)
+discovery = Discovery(config.get('NAME'),
+                      on_peer_found=lambda ip: main_loop.create_task(client.subscribe(ip)),
+                      on_peer_lost=lambda ip: main_loop.create_task(client.unsubscribe(ip)))
 
 
 runner = PreciseRunner(sensitivity=0.8,
                        trigger_level=1,
                        on_activation=on_activation,
                        on_listen_phrase=on_listen_phrase,
-                       on_finish_phrase=on_finish_phrase)
+                       on_finish_phrase=on_finish_phrase,
+                       lazy_load=True,
+                       playback_level=lambda: audio.level,
+                       echo=echo)
 
 if __name__ == "__main__":
     # asyncio.run(App().run())
 
     # p.force_wake_up()
     # tasks = [asyncio.create_task(coroutine) for coroutine in [client.run(None), runner.start()]]
+    log.info(f'Initialized in {(time.perf_counter() - boot_start) * 1000:.0f} ms')
     audio.play_file('sounds/boot.wav')
-    threading.Thread(target=udp_listener, args=(main_loop, queue), daemon=True).start()
-    threading.Thread(target=udp_broadcast, daemon=True).start()
+
+    async def listen():
+        await runner.start()
+        log.info(f'Listening {(time.perf_counter() - boot_start) * 1000:.0f} ms after start')
+
     main_loop.run_until_complete(
-        asyncio.gather(client.start(on_receive_data, on_peer_message), runner.start(), udp_consumer()))
+        asyncio.gather(session.start(on_receive_data, on_peer_message), listen(), discovery.run(),
+                       tracer.serve()))
     try:
-        print("[main] Starting asyncio event loop")
+        log.info("[main] Starting asyncio event loop")
         main_loop.run_forever()
     except KeyboardInterrupt:
-        print("[main] Stopping")
+        log.info("[main] Stopping")
     finally:
         runner.stop()
         audio.close()
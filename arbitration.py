@@ -0,0 +1,118 @@
+"""
+Picks one device when several hear the same wake word.
+
+Every device that activates publishes a claim with its wake word score and
+signal energy to its peers, then waits ARBITRATION_WINDOW_MS for theirs.
+Claims are matched by when they arrive on the local monotonic clock, device
+clocks are never compared. The highest score wins, energy and name break
+ties. Without known peers there is nothing to wait for and the claim is won
+at once. Listened audio is held locally until the claim is resolved, so
+losers never send anything to the router.
+"""
+import asyncio
+import json
+import time
+from threading import Lock
+
+import logger
+from config import config
+from tracing import tracer
+
+log = logger.get(__name__)
+
+ARBITRATION_WINDOW_MS = int(config.get('ARBITRATION_WINDOW_MS', 150))
+
+IDLE = 'idle'
+PENDING = 'pending'
+WON = 'won'
+LOST = 'lost'
+
+
+class Arbiter(object):
+    def __init__(self, name, publish, window=ARBITRATION_WINDOW_MS / 1000, peers=lambda: 1):
+        """`peers` returns how many peers discovery currently knows"""
+        self.name = name
+        self.publish = publish
+        self.window = window
+        self.peers = peers
+        self.lock = Lock()
+        self.state = IDLE
+        self.held = []
+        self.claim = None
+        self.claimed_at = 0.0
+        self.peer_claims = {}
+
+    def begin(self, score, energy):
+        """Starts a claim for a new activation, called from the capture thread"""
+        with self.lock:
+            self.claim = {'name': self.name, 'score': float(score), 'energy': float(energy)}
+            self.claimed_at = time.monotonic()
+            self.state = PENDING if self.window > 0 and self.peers() else WON
+            self.held = []
+        return self.claim
+
+    def accept(self):
+        """For a listen the router asked for with WAKEUP, there is nothing to arbitrate"""
+        with self.lock:
+            self.state = WON
+            self.held = []
+            self.claim = None
+
+    def hold(self, chunk):
+        """
+        Returns the chunks that can be sent now: nothing while the claim is
+        pending, lost or finished, the held audio followed by `chunk` once it is won
+        """
+        with self.lock:
+            if self.state == PENDING:
+                self.held.append(bytes(chunk))
+                return []
+            if self.state != WON:
+                return []
+            chunks = self.held + [chunk]
+            self.held = []
+            return chunks
+
+    @property
+    def owns_listen(self):
+        """Whether the current listen is this device's to finish: won, or still being claimed"""
+        return self.state in (WON, PENDING)
+
+    def on_claim(self, claim):
+        """Records a claim received from a peer, stamped with its local arrival time"""
+        self.peer_claims[claim['name']] = {**claim, 'received': time.monotonic()}
+
+    def _rivals(self):
+        # A peer that woke up at most a window before us is still waiting for our claim
+        return [
+            peer for peer in self.peer_claims.values()
+            if peer['name'] != self.name and peer['received'] >= self.claimed_at - self.window
+        ]
+
+    async def resolve(self, claim):
+        """Publishes the claim, waits for the window and returns whether this device won"""
+        with self.lock:
+            if self.claim is claim and self.state == WON:
+                return True
+        start = time.monotonic()
+        await self.publish(f'request claim {json.dumps(claim)}')
+        await asyncio.sleep(self.window)
+
+        rivals = self._rivals()
+        winner = max([claim] + rivals, key=lambda c: (c['score'], c['energy'], c['name']))
+        won = winner['name'] == self.name
+        with self.lock:
+            if self.claim is claim:
+                self.state = WON if won else LOST
+                if not won:
+                    self.held = []
+        tracer.observe('arbitration', time.monotonic() - start)
+        log.info(f'Arbitration {"won" if won else "lost to " + winner["name"]} '
+                 f'against {len(rivals)} peers in {(time.monotonic() - start) * 1000:.0f} ms')
+        return won
+
+    def finish(self):
+        with self.lock:
+            self.state = IDLE
+            self.held = []
+            self.claim = None
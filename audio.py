@@ -1,9 +1,49 @@
 import subprocess
+import time
+from threading import Event, Lock
+
+import numpy as np
 import pyaudio
 
+import logger
+from config import config
+from earcons import SoundCache
+from ring_buffer import RingBuffer, Overflow
+from tracing import tracer, FIRST_PLAYED
+
+# Most audio the jitter buffer holds before dropping the oldest
+PLAYBACK_BUFFER_MS = int(config.get('PLAYBACK_BUFFER_MS', 10000))
+# Audio buffered before playback starts, smooths out network jitter
+PLAYBACK_START_MS = int(config.get('PLAYBACK_START_MS', 60))
+# How earcons combine with speech playback: mix, duck or interrupt
+EARCON_MODE = config.get('EARCON_MODE', 'duck')
+EARCON_DUCK_GAIN = float(config.get('EARCON_DUCK_GAIN', 0.3))
+SOUND_CACHE_SIZE = int(config.get('SOUND_CACHE_SIZE', 16))
+
+log = logger.get(__name__)
+
+
+class Voice(object):
+    """An earcon being mixed into the output"""
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.position = 0
+        self.done = Event()
+
 
 class Audio(object):
-    """Streams raw audio from microphone. Data is received in a separate thread, and stored in a buffer, to be read from."""
+    """
+    Plays raw 16 kHz mono int16 audio.
+
+    Frames passed to play() go into a jitter buffer and are pulled by a
+    PortAudio callback, so play() never blocks the caller. Output starts once
+    PLAYBACK_START_MS are buffered, or when no more audio arrives for that long.
+    Earcons are decoded once into a SoundCache and mixed into the same output.
+    play() drops the oldest audio when the buffer is full, callers that must
+    not lose audio check room() first, like ResponseStream. Underruns and
+    overruns are published as playback_* tracer gauges.
+    """
     FORMAT = pyaudio.paInt16
     RATE_PROCESS = 16000
     CHANNELS = 1
@@ -15,30 +55,156 @@ class Audio(object):
         num_devices = info.get('deviceCount')
         for i in range(0, num_devices):
             if (self.pa.get_device_info_by_host_api_device_index(0, i).get('maxInputChannels')) > 0:
-                print("Input Device id ", i, " - ", self.pa.get_device_info_by_host_api_device_index(0, i).get('name'))
+                log.info(f"Input Device id {i} - {self.pa.get_device_info_by_host_api_device_index(0, i).get('name')}")
+
+        bytes_per_ms = self.RATE_PROCESS * 2 // 1000
+        self.buffer = RingBuffer(PLAYBACK_BUFFER_MS * bytes_per_ms, Overflow.DROP_OLDEST)
+        self.start_bytes = PLAYBACK_START_MS * bytes_per_ms
+        self.last_write = 0.0
+        self.playing = False
+        self.start_now = False
+        self.flushed_at = None
+        # Smoothed RMS of what is being played, in int16 units
+        self.level = 0.0
+        # echo.Reference fed with every output buffer when echo cancellation is on
+        self.reference = None
+        self.underruns = 0
+        self.device_underflows = 0
+        self.silence = b''
+        self.voices = []
+        self.voices_lock = Lock()
+        self.sounds = SoundCache(rate=self.RATE_PROCESS, max_entries=SOUND_CACHE_SIZE)
+        self.sounds.preload()
 
         self.stream = self.pa.open(format=self.pa.get_format_from_width(2),
                                    channels=1,
                                    rate=16000,
                                    output=True,
-                                   frames_per_buffer=1024)
+                                   frames_per_buffer=1024,
+                                   stream_callback=self._callback)
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        n = frame_count * 2
+        if len(self.silence) < n:
+            self.silence = bytes(n)
+        if status & pyaudio.paOutputUnderflow:
+            self.device_underflows += 1
+            tracer.gauge('playback_device_underflows', self.device_underflows)
+
+        if self.flushed_at is not None:
+            tracer.observe('flush_to_silence', time.monotonic() - self.flushed_at)
+            self.flushed_at = None
 
-    def play(self, frames):
-        self.stream.write(frames)
+        if not self.playing and len(self.buffer) and (
+                self.start_now or len(self.buffer) >= self.start_bytes
+                or time.monotonic() - self.last_write > PLAYBACK_START_MS / 1000):
+            self.playing = True
+            self.start_now = False
+            tracer.mark(FIRST_PLAYED)
+
+        data = self.buffer.read_available(n) if self.playing else b''
+        if len(data) < n:
+            if self.playing and not len(self.buffer):
+                self.underruns += 1
+                self.playing = False
+                tracer.gauge('playback_underruns', self.underruns)
+            data += self.silence[len(data):n]
+        if self.voices:
+            data = self._mix(data, frame_count)
+        self._track_level(data)
+        if self.reference is not None:
+            self.reference.write(data, self._play_time(time_info))
+        return data, pyaudio.paContinue
+
+    def _play_time(self, time_info):
+        """Monotonic time the buffer being returned reaches the speaker"""
+        latency = time_info.get('output_buffer_dac_time', 0) - time_info.get('current_time', 0)
+        if not 0 <= latency < 1:
+            latency = self.stream.get_output_latency()
+        return time.monotonic() + latency
+
+    def _track_level(self, data):
+        if not self.playing and not self.voices:
+            self.level *= 0.5
+            return
+        samples = np.frombuffer(data, dtype=np.int16).astype(np.float32)
+        rms = float(np.sqrt(np.dot(samples, samples) / max(len(samples), 1)))
+        # Rise at once, fall over a few buffers, like the echo tail in the room
+        self.level = max(rms, self.level * 0.7)
+
+    def _mix(self, data, frame_count):
+        mixed = np.frombuffer(data, dtype=np.int16).astype(np.int32)
+        if EARCON_MODE == 'duck' and self.playing:
+            mixed = (mixed * EARCON_DUCK_GAIN).astype(np.int32)
+        with self.voices_lock:
+            for voice in self.voices:
+                part = voice.samples[voice.position:voice.position + frame_count]
+                mixed[:len(part)] += part
+                voice.position += len(part)
+                if voice.position >= len(voice.samples):
+                    voice.done.set()
+            self.voices = [voice for voice in self.voices if not voice.done.is_set()]
+        return np.clip(mixed, -32768, 32767).astype(np.int16).tobytes()
+
+    def play(self, frames, start=False):
+        """
+        Queues frames for playback and returns immediately.
+        With start, output begins without waiting for PLAYBACK_START_MS of audio
+        """
+        self.last_write = time.monotonic()
+        dropped = self.buffer.dropped
+        self.buffer.write(frames)
+        if self.buffer.dropped != dropped:
+            tracer.gauge('playback_overrun_bytes', self.buffer.dropped)
+        if start:
+            self.start_now = True
+
+    def room(self):
+        """Bytes play() can take without dropping unplayed audio"""
+        return self.buffer.capacity - len(self.buffer)
+
+    @property
+    def busy(self):
+        return self.playing or len(self.buffer) > 0
+
+    def flush(self):
+        """Drops everything that has not been played yet"""
+        self.buffer.clear()
+        self.playing = False
+        self.start_now = False
+        self.flushed_at = time.monotonic()
+
+    def stats(self):
+        return {
+            'buffered_ms': len(self.buffer) // (self.RATE_PROCESS * 2 // 1000),
+            'underruns': self.underruns,
+            'device_underflows': self.device_underflows,
+            'overrun_bytes': self.buffer.dropped,
+        }
 
     def play_file_async(self, file):
-        try:
-            subprocess.Popen(["aplay", file])
-        except Exception as e:
-            print(f"Error playing sound: {e}")
+        """Mixes a cached sound into the output, falls back to aplay for other formats"""
+        samples = self.sounds.get(file)
+        if samples is None:
+            try:
+                subprocess.Popen(["aplay", file])
+            except Exception as e:
+                log.warning(f"Error playing sound: {e}")
+            return None
+
+        if EARCON_MODE == 'interrupt':
+            self.flush()
+        voice = Voice(samples)
+        with self.voices_lock:
+            self.voices.append(voice)
+        return voice
 
     def play_file(self, file):
-        try:
-            subprocess.run(["aplay", file], check=True)
-        except Exception as e:
-            print(f"Error playing sound: {e}")
+        voice = self.play_file_async(file)
+        if voice is not None:
+            voice.done.wait(len(voice.samples) / self.RATE_PROCESS + 1)
 
     def close(self):
-        # self.stream.stop_stream()
+        self.stream.stop_stream()
         self.stream.close()
         self.pa.terminate()
@@ -0,0 +1,311 @@
+"""
+Replays WAV files through PreciseRunner faster than real time and reports
+latency and accuracy per wake word model as JSON.
+
+Files under a directory named `positive` are expected to contain the wake
+word, files under `negative` must not, anything else is only timed.
+All files must be 16 kHz mono int16.
+
+    python benchmark.py corpus/ audio.wav --out bench.json
+
+With --echo, every file is also replayed with a playback file mixed in, as
+heard through a synthetic room (a direct path and a decaying reverb tail),
+once as is and once through echo.EchoCanceller, to compare recall while the
+speaker plays. Unlabelled files count as positives there.
+
+    python benchmark.py audio.wav --echo sounds/boot.wav --echo-gains 0.5,1,2
+"""
+import argparse
+import glob
+import json
+import os
+import time
+import wave
+
+import numpy as np
+
+import logger
+from earcons import decode_wav
+from echo import EchoCanceller
+from runner import PreciseRunner, ReadWriteStream
+
+log = logger.get(__name__)
+
+RATE = 16000
+POSITIVE = 'positive'
+NEGATIVE = 'negative'
+# Playback heard before the speech starts, so the echo canceller has something to adapt on
+ECHO_LEAD_S = 1.0
+
+
+def find_wavs(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            yield from sorted(glob.glob(os.path.join(path, '**', '*.wav'), recursive=True))
+        else:
+            yield path
+
+
+def label_of(path):
+    parts = os.path.normpath(path).split(os.sep)
+    if POSITIVE in parts:
+        return POSITIVE
+    if NEGATIVE in parts:
+        return NEGATIVE
+    return None
+
+
+def read_wav(path):
+    with wave.open(path, 'rb') as f:
+        if f.getframerate() != RATE or f.getnchannels() != 1 or f.getsampwidth() != 2:
+            log.warning(f'Skipping {path}: expected {RATE} Hz mono int16')
+            return None
+        return f.readframes(f.getnframes())
+
+
+def list_models(models_dir='models'):
+    return sorted(os.path.splitext(os.path.basename(p))[0] for p in glob.glob(os.path.join(models_dir, '*.tflite')))
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = np.asarray(values) * 1000
+    return {
+        'p50_ms': float(np.percentile(values, 50)),
+        'p90_ms': float(np.percentile(values, 90)),
+        'p99_ms': float(np.percentile(values, 99)),
+        'max_ms': float(values.max()),
+        'count': int(len(values)),
+    }
+
+
+class Timed(object):
+    """Wraps a callable and records the duration of every call"""
+
+    def __init__(self, func):
+        self.func = func
+        self.durations = []
+
+    def __call__(self, *args):
+        start = time.perf_counter()
+        result = self.func(*args)
+        self.durations.append(time.perf_counter() - start)
+        return result
+
+
+class CountingStream(ReadWriteStream):
+    """ReadWriteStream that knows how many samples were consumed"""
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.samples = 0
+        self.close()
+
+    def read(self, n=-1, timeout=None):
+        chunk = super().read(n, timeout)
+        self.samples += len(chunk) // 2
+        return chunk
+
+
+class PlaybackReference(object):
+    """echo.Reference stand-in that returns the playback aligned with what the stream has consumed"""
+
+    def __init__(self):
+        self.samples = np.zeros(0, dtype=np.int16)
+        self.stream = None
+
+    def load(self, samples, stream):
+        self.samples = samples
+        self.stream = stream
+
+    def read(self, start_time, out):
+        end = self.stream.samples
+        part = self.samples[max(end - len(out), 0):end]
+        out[:] = 0
+        out[len(out) - len(part):] = part
+
+
+def room_response(gain, delay_ms=8, tail_ms=60, seed=0):
+    """Loudspeaker to microphone impulse response with a direct path of `gain`"""
+    rng = np.random.default_rng(seed)
+    delay = int(RATE * delay_ms / 1000)
+    tail = int(RATE * tail_ms / 1000)
+    response = np.zeros(delay + tail)
+    response[delay] = 1.0
+    response[delay + 1:] = rng.standard_normal(tail - 1) * 0.3 * np.exp(-np.arange(tail - 1) / (tail / 4))
+    return response * gain
+
+
+def with_echo(files, playback, gain):
+    """
+    Returns the files with ECHO_LEAD_S of playback first and the playback
+    echo mixed in throughout, and the playback sent to the speaker for each
+    """
+    mixed = []
+    references = {}
+    lead = int(ECHO_LEAD_S * RATE)
+    for path, label, data in files:
+        speech = np.frombuffer(data, dtype=np.int16)
+        length = lead + len(speech)
+        reference = np.resize(playback, length)
+        echo = np.convolve(reference.astype(np.float32), room_response(gain))[:length]
+        echo[lead:] += speech
+        mixed.append((path, label if label else POSITIVE, np.clip(echo, -32768, 32767).astype(np.int16).tobytes()))
+        references[path] = reference
+    return mixed, references
+
+
+def echo_return_loss(playback, gain, seconds=4.0):
+    """ERLE in dB of the canceller on playback alone, over the second half once it has adapted"""
+    canceller = EchoCanceller(None)
+    block = canceller.block
+    reference = np.resize(playback, int(seconds * RATE) // block * block).astype(np.float32) / 32768
+    echo = np.convolve(reference, room_response(gain))[:len(reference)].astype(np.float32)
+    residual = np.concatenate([canceller.cancel(echo[i:i + block], reference[i:i + block])
+                               for i in range(0, len(reference), block)])
+    half = len(reference) // 2
+    return float(10 * np.log10(np.dot(echo[half:], echo[half:]) / max(np.dot(residual[half:], residual[half:]), 1e-12)))
+
+
+def benchmark_model(name, files, sensitivity, trigger_level, references=None):
+    """With `references`, the playback for each file path, the runner cancels its echo first"""
+    result = {'activations': 0, 'files': []}
+    state = {}
+
+    def on_activation(wake_word):
+        state['activations'].append((state['stream'].samples, wake_word))
+
+    def on_finish_phrase(speech_detected, data):
+        state['finished'] = state['stream'].samples
+
+    runner = PreciseRunner(sensitivity=sensitivity, trigger_level=trigger_level,
+                           wake_word=name,
+                           on_activation=on_activation,
+                           on_finish_phrase=on_finish_phrase,
+                           echo=EchoCanceller(PlaybackReference()) if references else None)
+    if runner.echo:
+        echo = runner.echo.process = Timed(runner.echo.process)
+    predict = runner.inference.predict = Timed(runner.inference.predict)
+    vad = Timed(runner.inference.vad)
+
+    def timed_vad(chunk):
+        probability = vad(chunk)
+        if probability > 0.5:
+            state['last_speech'] = state['stream'].samples
+        return probability
+
+    runner.inference.vad = timed_vad
+
+    audio_seconds = 0.0
+    processing_seconds = 0.0
+    eos_delays = []
+    for path, label, data in files:
+        runner.reset()
+        state.update(stream=CountingStream(data), activations=[], finished=None, last_speech=None)
+        runner.stream = state['stream']
+        if runner.echo:
+            runner.echo.reset()
+            runner.echo.reference.load(references[path], state['stream'])
+        runner.running = True
+        start = time.perf_counter()
+        runner._handle_predictions()
+        processing_seconds += time.perf_counter() - start
+        runner.running = False
+
+        duration = len(data) / 2 / RATE
+        audio_seconds += duration
+        result['activations'] += len(state['activations'])
+        if state['finished'] is not None and state['last_speech'] is not None:
+            eos_delays.append(max(state['finished'] - state['last_speech'], 0) / RATE)
+        result['files'].append({
+            'path': path,
+            'label': label,
+            'duration_s': duration,
+            'activations': [{'s': s / RATE, 'wake_word': w} for s, w in state['activations']],
+        })
+    runner.reset()
+    runner.inference.close()
+
+    labelled = [f for f in result['files'] if f['label']]
+    positives = [f for f in labelled if f['label'] == POSITIVE]
+    negatives = [f for f in labelled if f['label'] == NEGATIVE]
+    negative_hours = sum(f['duration_s'] for f in negatives) / 3600
+    result.update({
+        'predict_latency': percentiles(predict.durations),
+        'vad_latency': percentiles(vad.durations),
+        'audio_s': audio_seconds,
+        'real_time_factor': processing_seconds / audio_seconds if audio_seconds else None,
+        'recall': sum(1 for f in positives if f['activations']) / len(positives) if positives else None,
+        'false_accepts': sum(len(f['activations']) for f in negatives),
+        'false_accepts_per_hour': (
+            sum(len(f['activations']) for f in negatives) / negative_hours if negative_hours else None
+        ),
+        'end_of_speech_delay': percentiles(eos_delays),
+        'gate': runner.gate.stats() if runner.gate else None,
+    })
+    if runner.echo:
+        result['echo_cancel_latency'] = percentiles(echo.durations)
+        result['echo'] = runner.echo.stats()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='*', default=['audio.wav'], help='WAV files or directories')
+    parser.add_argument('--models', help='Comma separated model names, defaults to every model in models/')
+    parser.add_argument('--sensitivity', type=float, default=0.8)
+    parser.add_argument('--trigger-level', type=int, default=1)
+    parser.add_argument('--combined', action='store_true',
+                        help='Also run all models together, to measure the cost of each extra wake word')
+    parser.add_argument('--echo', metavar='PLAYBACK',
+                        help='Also replay the files with this WAV playing on the speaker, with and without echo cancellation')
+    parser.add_argument('--echo-gains', default='0.5,1,2',
+                        help='Comma separated speaker to microphone gains of the direct echo path')
+    parser.add_argument('--out', help='Write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    files = []
+    for path in find_wavs(args.paths):
+        data = read_wav(path)
+        if data:
+            files.append((path, label_of(path), data))
+
+    models = args.models.split(',') if args.models else list_models()
+    report = {'files': len(files), 'models': {}}
+    for name in models:
+        log.info(f'Benchmarking {name} on {len(files)} files')
+        report['models'][name] = benchmark_model(name, files, args.sensitivity, args.trigger_level)
+
+    if args.combined and len(models) > 1:
+        combined = ','.join(models)
+        log.info(f'Benchmarking {combined} together')
+        report['combined'] = benchmark_model(combined, files, args.sensitivity, args.trigger_level)
+        single = [report['models'][name]['predict_latency']['p50_ms'] for name in models]
+        report['combined']['extra_model_p50_ms'] = (
+            (report['combined']['predict_latency']['p50_ms'] - min(single)) / (len(models) - 1)
+        )
+
+    if args.echo:
+        playback = decode_wav(args.echo, RATE)
+        report['echo'] = {'playback': args.echo, 'gains': {}}
+        for gain in [float(g) for g in args.echo_gains.split(',')]:
+            mixed, references = with_echo(files, playback, gain)
+            runs = report['echo']['gains'][str(gain)] = {'erle_db': echo_return_loss(playback, gain), 'models': {}}
+            for name in models:
+                log.info(f'Benchmarking {name} with echo gain {gain}')
+                runs['models'][name] = {
+                    'without': benchmark_model(name, mixed, args.sensitivity, args.trigger_level),
+                    'with': benchmark_model(name, mixed, args.sensitivity, args.trigger_level, references),
+                }
+
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Microphone capture in PortAudio callback mode.
+
+The PortAudio callback only copies each buffer into a RingBuffer and records
+when its first sample hit the ADC, so a slow consumer never stalls the
+driver. Readers take frames of any size, independent of the device
+frames_per_buffer, together with the monotonic capture time of their last
+sample. Device overflows and frames dropped from the ring are counted.
+"""
+import time
+from collections import deque
+
+import pyaudio
+
+import logger
+from config import config
+from ring_buffer import RingBuffer, Overflow
+
+log = logger.get(__name__)
+
+# Frames PortAudio hands to the callback at once, smaller means lower latency
+CAPTURE_FRAMES_PER_BUFFER = int(config.get('CAPTURE_FRAMES_PER_BUFFER', 256))
+# Audio the ring holds for a slow consumer before the oldest is dropped
+CAPTURE_BUFFER_MS = int(config.get('CAPTURE_BUFFER_MS', 10000))
+SOUND_DEVICE_INDEX = int(config.get('SOUND_DEVICE_INDEX', 0))
+
+
+class Capture(object):
+    """
+    Opens the input device and buffers 16 kHz mono int16 audio from it.
+    read(n) is a drop-in replacement for a blocking stream read of n bytes,
+    readinto_frame(buffer) fills a preallocated buffer and also returns the
+    capture time of the frame.
+    """
+    RATE = 16000
+
+    def __init__(self, rate=RATE, frames_per_buffer=CAPTURE_FRAMES_PER_BUFFER,
+                 device_index=SOUND_DEVICE_INDEX, buffer_ms=CAPTURE_BUFFER_MS):
+        self.rate = rate
+        self.ring = RingBuffer(rate * 2 * buffer_ms // 1000, Overflow.DROP_OLDEST)
+        # (sample index, monotonic ADC time) of the first sample of every callback buffer
+        self.anchors = deque()
+        self.written = 0
+        self.callbacks = 0
+        self.input_overflows = 0
+        self.input_underflows = 0
+        self.reported_drops = 0
+        self.drop_throttle = logger.Throttle(5.0)
+        self.pa = pyaudio.PyAudio()
+        self.stream = self.pa.open(rate, 1, pyaudio.paInt16, input=True,
+                                   input_device_index=device_index,
+                                   frames_per_buffer=frames_per_buffer,
+                                   stream_callback=self._callback)
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        now = time.monotonic()
+        adc_time = time_info.get('input_buffer_adc_time') if time_info else None
+        current_time = time_info.get('current_time') if time_info else None
+        if adc_time and current_time:
+            captured = now - (current_time - adc_time)
+        else:
+            captured = now - frame_count / self.rate
+        if status & pyaudio.paInputOverflow:
+            self.input_overflows += 1
+        if status & pyaudio.paInputUnderflow:
+            self.input_underflows += 1
+
+        with self.ring.cond:
+            self.anchors.append((self.written // 2, captured))
+            self.ring.write(in_data)
+            self.written += len(in_data)
+        self.callbacks += 1
+        return None, pyaudio.paContinue
+
+    def _capture_time(self, sample):
+        """Monotonic time at which the given sample index was captured"""
+        while len(self.anchors) > 1 and self.anchors[1][0] <= sample:
+            self.anchors.popleft()
+        if not self.anchors:
+            return time.monotonic()
+        index, captured = self.anchors[0]
+        return captured + (sample - index) / self.rate
+
+    def readinto_frame(self, buffer, timeout=None):
+        """
+        Blocks until the buffer is filled. Returns the number of bytes copied
+        and the capture time of the last sample, 0 bytes once the capture is closed
+        """
+        with self.ring.cond:
+            n = self.ring.readinto(buffer, timeout)
+            end = (self.written - len(self.ring)) // 2
+            captured = self._capture_time(max(end - 1, 0)) if n else time.monotonic()
+            dropped = self.ring.dropped
+        if dropped != self.reported_drops and self.drop_throttle() is not None:
+            log.warning(f'Capture ring overflowed, {dropped - self.reported_drops} bytes dropped')
+            self.reported_drops = dropped
+        return n, captured
+
+    def read_frame(self, n, timeout=None):
+        """Same as readinto_frame, but returns a copy of n bytes"""
+        data = bytearray(n)
+        n, captured = self.readinto_frame(data, timeout)
+        return bytes(data[:n]), captured
+
+    def read(self, n, timeout=None):
+        return self.read_frame(n, timeout)[0]
+
+    def stats(self):
+        return {
+            'callbacks': self.callbacks,
+            'input_overflows': self.input_overflows,
+            'input_underflows': self.input_underflows,
+            'dropped_bytes': self.ring.dropped,
+            'buffered_ms': len(self.ring) * 1000 // (self.rate * 2),
+        }
+
+    def close(self):
+        """Stops the device, readers get what is still buffered and then empty frames"""
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.pa.terminate()
+            self.stream = None
+        self.ring.close()
+        log.info(f'Capture stopped: {self.stats()}')
@@ -7,22 +7,45 @@ from zmq.asyncio import Context
 import logger
 from commands import Command
 from config import config
+from tracing import tracer, FIRST_CONTINUE, FINISH_SENT, FIRST_SPEAK
 
 log = logger.get(__name__)
 
 SUB_FILTER = 'request'
+# ZMTP heartbeats, a router that stops answering is dropped after the timeout and reconnected
+ROUTER_HEARTBEAT_IVL = int(config.get('ROUTER_HEARTBEAT_IVL', 1000))  # ms
+ROUTER_HEARTBEAT_TIMEOUT = int(config.get('ROUTER_HEARTBEAT_TIMEOUT', 3000))  # ms
+ROUTER_RECONNECT_IVL = int(config.get('ROUTER_RECONNECT_IVL', 100))  # ms
+ROUTER_RECONNECT_IVL_MAX = int(config.get('ROUTER_RECONNECT_IVL_MAX', 2000))  # ms
+# Messages libzmq may hold for the router, the session queue holds the rest
+ROUTER_SNDHWM = int(config.get('ROUTER_SNDHWM', 64))
 
 
 class Client:
-    def __init__(self, url: str, name: str):
+    def __init__(self, url: str, name: str, greeting: dict = None, peers_port=None):
+        """peers_port defaults to ZEROMQ_PEERS_PORT, 0 binds the peer socket to a random local port"""
         self.name = name
+        self.greeting = greeting
+        self.peers_port = config.get('ZEROMQ_PEERS_PORT') if peers_port is None else peers_port
         context = Context.instance()
         socket = context.socket(zmq.DEALER)
         socket.setsockopt_string(zmq.IDENTITY, name)
+        socket.setsockopt(zmq.HEARTBEAT_IVL, ROUTER_HEARTBEAT_IVL)
+        socket.setsockopt(zmq.HEARTBEAT_TIMEOUT, ROUTER_HEARTBEAT_TIMEOUT)
+        socket.setsockopt(zmq.HEARTBEAT_TTL, ROUTER_HEARTBEAT_TIMEOUT)
+        socket.setsockopt(zmq.RECONNECT_IVL, ROUTER_RECONNECT_IVL)
+        socket.setsockopt(zmq.RECONNECT_IVL_MAX, ROUTER_RECONNECT_IVL_MAX)
+        socket.setsockopt(zmq.SNDHWM, ROUTER_SNDHWM)
+        # Only queue messages on completed connections, so nothing piles up in libzmq while the router is away
+        socket.setsockopt(zmq.IMMEDIATE, 1)
+        socket.setsockopt(zmq.LINGER, 0)
         socket.connect(f'tcp://{url}')
 
         self.pub = context.socket(zmq.PUB)
-        self.pub.bind(f"tcp://*:{config.get('ZEROMQ_PEERS_PORT')}")
+        if self.peers_port:
+            self.pub.bind(f"tcp://*:{self.peers_port}")
+        else:
+            self.peers_port = self.pub.bind_to_random_port('tcp://127.0.0.1')
 
         self.sub = context.socket(zmq.SUB)
         self.sub.setsockopt_string(zmq.SUBSCRIBE, SUB_FILTER)
@@ -31,31 +54,45 @@ class Client:
         self.socket = socket
 
     async def greet(self):
-        log.info('Sending greetings to router')
-        await self.socket.send_multipart([b"GREET", b""])
+        log.info(f'Sending greetings to router: {self.greeting}')
+        await self.socket.send_multipart([b"GREET", json.dumps(self.greeting).encode() if self.greeting else b""])
 
     async def publish(self, message):
-        log.info(f'Publish message to peers: {message}')
+        log.debug('Publish message to peers: %s', message)
         self.pub.send_string(message)
 
     async def subscribe(self, ip):
         log.info(f'Subscribing to {ip}')
-        self.sub.connect(f"tcp://{ip}:{config.get('ZEROMQ_PEERS_PORT')}")
-
-    async def send(self, command: Command, chunk):
-        await self.socket.send_multipart([command, chunk])
+        self.sub.connect(f"tcp://{ip}:{self.peers_port}")
+
+    async def unsubscribe(self, ip):
+        log.info(f'Unsubscribing from {ip}')
+        try:
+            self.sub.disconnect(f"tcp://{ip}:{self.peers_port}")
+        except zmq.ZMQError as e:
+            log.info(f'Was not subscribed to {ip}: {e}')
+
+    async def send(self, command: Command, *chunks, flags=0):
+        await self.socket.send_multipart([command, *chunks], flags=flags, copy=False)
+        if command == Command.CONTINUE.value:
+            tracer.mark(FIRST_CONTINUE)
+        elif command == Command.FINISH.value:
+            tracer.mark(FINISH_SENT)
 
     async def peer_listener(self, callback):
         while True:
             msg = await self.sub.recv_string()
-            msg = msg.split()
-            log.info(f"Got message from peer: {msg}")
-            callback(msg[1])
+            msg = msg.split(maxsplit=2)
+            log.debug('Got message from peer: %s', msg)
+            callback(*msg[1:])
 
-    async def router_listen(self, callback):
-        await self.greet()
+    async def router_listen(self, callback, greet=True):
+        if greet:
+            await self.greet()
         while True:
             tag, params, audio = await self.socket.recv_multipart()
+            if tag == b'SPEAK':
+                tracer.mark(FIRST_SPEAK)
             params_decode = params.decode()
             callback(tag.decode(), json.loads(params_decode) if len(params_decode) else None, audio)
 
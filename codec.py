@@ -0,0 +1,141 @@
+import numpy as np
+
+import logger
+
+log = logger.get(__name__)
+
+PCM16 = 'pcm16'
+MULAW = 'mulaw'
+OPUS = 'opus'
+
+RATE = 16000
+
+_MULAW_BIAS = 0x84
+_MULAW_CLIP = 32635
+
+
+class Pcm16Codec(object):
+    """Raw 16 kHz mono int16, what the router receives without a codec"""
+    name = PCM16
+
+    def encode(self, chunk):
+        # Chunks may be views into reused capture frames, the packet has to own its data
+        return [chunk if isinstance(chunk, bytes) else bytes(chunk)]
+
+    def flush(self):
+        return []
+
+    def decode(self, packet):
+        return packet
+
+
+class MulawCodec(object):
+    """G.711 mu-law, vectorized with NumPy. Halves the uplink bandwidth"""
+    name = MULAW
+
+    def encode(self, chunk):
+        samples = np.frombuffer(chunk, dtype=np.int16).astype(np.int32)
+        sign = (samples < 0).astype(np.int32) << 7
+        magnitude = np.minimum(np.abs(samples), _MULAW_CLIP) + _MULAW_BIAS
+        exponent = np.frexp(magnitude)[1] - 8
+        mantissa = (magnitude >> (exponent + 3)) & 0x0F
+        return [(~(sign | (exponent << 4) | mantissa) & 0xFF).astype(np.uint8).tobytes()]
+
+    def flush(self):
+        return []
+
+    def decode(self, packet):
+        encoded = ~np.frombuffer(packet, dtype=np.uint8).astype(np.int32) & 0xFF
+        exponent = (encoded >> 4) & 0x07
+        magnitude = (((encoded & 0x0F) << 3) + _MULAW_BIAS << exponent) - _MULAW_BIAS
+        return np.where(encoded & 0x80, -magnitude, magnitude).astype(np.int16).tobytes()
+
+
+class OpusCodec(object):
+    """
+    Opus voice codec, requires the optional opuslib package.
+    Opus takes 20 ms frames, leftover samples are kept for the next chunk
+    """
+    name = OPUS
+    FRAME_SAMPLES = RATE // 50
+
+    def __init__(self, bitrate=16000):
+        import opuslib
+
+        self.encoder = opuslib.Encoder(RATE, 1, opuslib.APPLICATION_VOIP)
+        self.encoder.bitrate = bitrate
+        self.decoder = opuslib.Decoder(RATE, 1)
+        self.pending = bytearray()
+
+    def encode(self, chunk):
+        self.pending.extend(chunk)
+        frame_bytes = self.FRAME_SAMPLES * 2
+        packets = []
+        offset = 0
+        while len(self.pending) - offset >= frame_bytes:
+            packets.append(self.encoder.encode(bytes(self.pending[offset:offset + frame_bytes]), self.FRAME_SAMPLES))
+            offset += frame_bytes
+        del self.pending[:offset]
+        return packets
+
+    def flush(self):
+        if not self.pending:
+            return []
+        padding = self.FRAME_SAMPLES * 2 - len(self.pending)
+        return self.encode(b'\0' * padding)
+
+    def decode(self, packet):
+        return self.decoder.decode(packet, self.FRAME_SAMPLES)
+
+
+def get_codec(name):
+    """Returns a codec by name, falling back to mu-law when opuslib is missing"""
+    if name == OPUS:
+        try:
+            return OpusCodec()
+        except ImportError:
+            log.warning('opuslib is not installed, falling back to mu-law')
+            return MulawCodec()
+    if name == MULAW:
+        return MulawCodec()
+    return Pcm16Codec()
+
+
+class Uplink(object):
+    """
+    Encodes CONTINUE audio and coalesces it into batches,
+    so one message carries `batch` chunks as separate frames
+    """
+
+    def __init__(self, codec=PCM16, batch=1):
+        self.codec = get_codec(codec)
+        self.batch = max(int(batch), 1)
+        self.packets = []
+        self.chunks = 0
+
+    def greeting(self):
+        """Parameters sent to the router with GREET"""
+        return {'codec': self.codec.name, 'batch': self.batch, 'rate': RATE}
+
+    def push(self, chunk):
+        """Returns the packets to send once a batch is complete, otherwise an empty list"""
+        self.packets.extend(self.codec.encode(chunk))
+        self.chunks += 1
+        if self.chunks < self.batch:
+            return []
+        return self._take()
+
+    def flush(self):
+        """Returns whatever is pending, used before FINISH"""
+        self.packets.extend(self.codec.flush())
+        return self._take()
+
+    def reset(self):
+        self.codec.flush()
+        self._take()
+
+    def _take(self):
+        packets = self.packets
+        self.packets = []
+        self.chunks = 0
+        return packets
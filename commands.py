@@ -7,3 +7,4 @@ class Command(Enum):
     FINISH = b'FINISH'
     CANCEL = b'CANCEL'
     CLEAR = b'CLEAR'
+    PING = b'PING'
@@ -1,11 +1,20 @@
 import os
-import netifaces
 
 from dotenv import dotenv_values
 
+SYS_NET = '/sys/class/net'
 
-def get_mac_address(interface="eth0"):
-    print(netifaces.interfaces())
+
+def get_mac_address(interface=None):
+    """Reads the MAC address from sysfs, falling back to netifaces off Linux"""
+    try:
+        interfaces = [interface] if interface else sorted(i for i in os.listdir(SYS_NET) if i != 'lo')
+        for name in interfaces:
+            with open(os.path.join(SYS_NET, name, 'address')) as f:
+                return f.read().strip()
+    except OSError:
+        pass
+    import netifaces
     return netifaces.ifaddresses(netifaces.interfaces()[1])[netifaces.AF_LINK][0]['addr']
 
 
@@ -0,0 +1,73 @@
+import glob
+import os
+import wave
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+import logger
+
+log = logger.get(__name__)
+
+_DTYPES = {1: np.uint8, 2: np.int16, 4: np.int32}
+
+
+def decode_wav(path, rate=16000):
+    """Reads a WAV file as mono int16 samples resampled to `rate`"""
+    with wave.open(path, 'rb') as f:
+        width = f.getsampwidth()
+        if width not in _DTYPES:
+            raise ValueError(f'Unsupported sample width {width} in {path}')
+        channels = f.getnchannels()
+        source_rate = f.getframerate()
+        samples = np.frombuffer(f.readframes(f.getnframes()), dtype=_DTYPES[width]).astype(np.float32)
+
+    if width == 1:
+        samples = (samples - 128) * 256
+    elif width == 4:
+        samples /= 65536
+    samples = samples.reshape(-1, channels).mean(axis=1)
+    if source_rate != rate:
+        duration = len(samples) / source_rate
+        positions = np.arange(int(duration * rate)) * (source_rate / rate)
+        samples = np.interp(positions, np.arange(len(samples)), samples)
+    return np.clip(samples, -32768, 32767).astype(np.int16)
+
+
+class SoundCache(object):
+    """
+    Decoded earcons kept in memory, so playing one is a buffer lookup
+    instead of spawning aplay. Holds at most `max_entries` sounds,
+    least recently used ones are dropped first
+    """
+
+    def __init__(self, directory='sounds', rate=16000, max_entries=16):
+        self.directory = directory
+        self.rate = rate
+        self.max_entries = max_entries
+        self.sounds = OrderedDict()
+        self.lock = Lock()
+
+    def preload(self):
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.wav')))[:self.max_entries]:
+            self.get(path)
+        log.info(f'Preloaded {len(self.sounds)} sounds from {self.directory}')
+
+    def get(self, path):
+        """Returns the samples of a sound, or None when it can not be decoded"""
+        path = os.path.normpath(path)
+        with self.lock:
+            if path in self.sounds:
+                self.sounds.move_to_end(path)
+                return self.sounds[path]
+        try:
+            samples = decode_wav(path, self.rate)
+        except (OSError, EOFError, ValueError, wave.Error) as e:
+            log.warning(f'Can not decode {path}: {e}')
+            return None
+        with self.lock:
+            self.sounds[path] = samples
+            while len(self.sounds) > self.max_entries:
+                self.sounds.popitem(last=False)
+        return samples
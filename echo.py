@@ -0,0 +1,158 @@
+"""
+Acoustic echo cancellation for the microphone, using what the speaker plays as reference.
+
+Audio writes every output buffer (speech and earcons after mixing) into a
+Reference, stamped with the time it reaches the DAC. The runner hands each
+captured chunk to EchoCanceller, which reads the reference samples played
+during that chunk and subtracts their estimated echo. The echo path is
+modelled by a partitioned block frequency domain adaptive filter (normalized
+LMS, overlap-save), ECHO_PARTITIONS blocks of one chunk each long, so about
+128 ms of room reverberation with 512 sample chunks. Once the filter removes
+most of the echo, a block it removes little from is taken as near end
+speech and does not adapt the filter, for at most ECHO_FREEZE_BLOCKS in a row
+so that a changed echo path is still learned.
+"""
+from threading import Lock
+
+import numpy as np
+
+from config import config
+
+ECHO_CANCEL = config.get('ECHO_CANCEL', 'false').lower() in ('1', 'true', 'yes')
+ECHO_PARTITIONS = int(config.get('ECHO_PARTITIONS', 4))
+# NLMS step size, larger converges faster but leaves more residual echo
+ECHO_STEP = float(config.get('ECHO_STEP', 0.3))
+# Near end talk is assumed when this much of the mic energy is left after cancelling
+ECHO_DOUBLE_TALK = float(config.get('ECHO_DOUBLE_TALK', 0.5))
+# Most blocks in a row adaptation is paused for near end talk, about 1 s
+ECHO_FREEZE_BLOCKS = int(config.get('ECHO_FREEZE_BLOCKS', 32))
+# Energy left after cancelling, below which the filter counts as converged
+ECHO_CONVERGED = 0.1
+# Extra latency between the DAC time and the mic, on top of what PortAudio reports
+ECHO_DELAY_MS = float(config.get('ECHO_DELAY_MS', 0))
+
+
+class Reference(object):
+    """The last `seconds` of speaker output, addressed by the monotonic time it was played"""
+
+    def __init__(self, rate=16000, seconds=2.0):
+        self.rate = rate
+        self.samples = np.zeros(int(rate * seconds), dtype=np.int16)
+        self.end = 0
+        self.end_time = None
+        self.lock = Lock()
+
+    def write(self, data, play_time):
+        """Appends output whose first sample reaches the speaker at `play_time`"""
+        samples = np.frombuffer(data, dtype=np.int16)[-len(self.samples):]
+        size = len(self.samples)
+        with self.lock:
+            position = self.end % size
+            first = min(len(samples), size - position)
+            self.samples[position:position + first] = samples[:first]
+            self.samples[:len(samples) - first] = samples[first:]
+            self.end += len(samples)
+            self.end_time = play_time + len(samples) / self.rate
+
+    def read(self, start_time, out):
+        """Fills `out` with what was played from `start_time` on, silence where unknown"""
+        out[:] = 0
+        with self.lock:
+            if self.end_time is None:
+                return
+            size = len(self.samples)
+            start = self.end - int(round((self.end_time - start_time) * self.rate))
+            first = max(start, self.end - size)
+            last = min(start + len(out), self.end)
+            if first >= last:
+                return
+            # At most two pieces, split where the ring wraps around
+            position = first % size
+            count = last - first
+            head = min(count, size - position)
+            out[first - start:first - start + head] = self.samples[position:position + head]
+            out[first - start + head:last - start] = self.samples[:count - head]
+
+
+class EchoCanceller(object):
+    def __init__(self, reference, block=512, partitions=ECHO_PARTITIONS, step=ECHO_STEP,
+                 double_talk=ECHO_DOUBLE_TALK, freeze_blocks=ECHO_FREEZE_BLOCKS, delay_ms=ECHO_DELAY_MS,
+                 rate=16000):
+        self.reference = reference
+        self.block = block
+        self.partitions = partitions
+        self.step = step
+        self.double_talk = double_talk
+        self.freeze_blocks = freeze_blocks
+        self.delay = delay_ms / 1000
+        self.rate = rate
+        self.ref = np.zeros(block, dtype=np.int16)
+        self.reset()
+
+    def reset(self):
+        n = self.block
+        self.window = np.zeros(2 * n, dtype=np.float32)
+        self.spectra = np.zeros((self.partitions, n + 1), dtype=np.complex64)
+        self.weights = np.zeros((self.partitions, n + 1), dtype=np.complex64)
+        self.power = np.zeros(n + 1, dtype=np.float32)
+        self.peaks = np.zeros(self.partitions, dtype=np.float32)
+        self.converged = False
+        self.freeze = 0
+        self.adapted = 0
+        self.frozen = 0
+
+    def cancel(self, mic, ref):
+        """Returns the mic block with the echo of `ref` removed, both float32 of `block` samples"""
+        n = self.block
+        self.window[:n] = self.window[n:]
+        self.window[n:] = ref
+        self.spectra = np.roll(self.spectra, 1, axis=0)
+        self.spectra[0] = np.fft.rfft(self.window)
+        self.peaks = np.roll(self.peaks, 1)
+        self.peaks[0] = np.abs(ref).max()
+
+        echo = np.fft.irfft((self.weights * self.spectra).sum(axis=0))[n:]
+        error = (mic - echo).astype(np.float32)
+
+        if self.peaks.max() < 1e-4:
+            return error
+        mic_energy = np.dot(mic, mic)
+        left = np.dot(error, error) / mic_energy if mic_energy > 0 else 0.0
+        if self.converged and left > self.double_talk and self.freeze < self.freeze_blocks:
+            self.freeze += 1
+            self.frozen += 1
+            return error
+        if self.freeze >= self.freeze_blocks:
+            # Talking that long is more likely a new echo path, learn it again
+            self.converged = False
+        self.freeze = 0
+        self.converged = self.converged or left < ECHO_CONVERGED
+
+        power = (np.abs(self.spectra) ** 2).sum(axis=0)
+        self.power = power if not self.adapted else 0.9 * self.power + 0.1 * power
+        self.adapted += 1
+        spectrum = np.fft.rfft(np.concatenate((np.zeros(n, dtype=np.float32), error)))
+        gradient = self.step * np.conj(self.spectra) * spectrum / (self.power + 1e-6 * n * n)
+        # Keep the filter causal: zero the second half of every partition's impulse response
+        impulse = np.fft.irfft(gradient, axis=1)
+        impulse[:, n:] = 0
+        self.weights += np.fft.rfft(impulse, axis=1).astype(np.complex64)
+        return error
+
+    def process(self, frame):
+        """Cancels the echo in a frames.Frame in place, using the reference played while it was captured"""
+        length = frame.length
+        if length != self.block:
+            return
+        start = frame.captured - (length - 1) / self.rate - self.delay
+        self.reference.read(start, self.ref)
+        if not self.ref.any() and not self.adapted:
+            return
+        samples = frame.int16
+        error = self.cancel(samples * np.float32(1 / 32768), self.ref * np.float32(1 / 32768))
+        np.clip(error * 32768, -32768, 32767, out=error)
+        samples[:] = error
+        frame.filled(length * 2, frame.captured)
+
+    def stats(self):
+        return {'adapted_blocks': self.adapted, 'frozen_blocks': self.frozen}
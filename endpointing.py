@@ -0,0 +1,94 @@
+IDLE = 'idle'
+WAITING = 'waiting'
+SPEAKING = 'speaking'
+TRAILING = 'trailing'
+
+NO_SPEECH = 'no_speech'
+FINISHED = 'finished'
+
+
+class Endpointer(object):
+    """
+    Decides when an utterance is over from VAD probabilities.
+
+    Time is measured in processed samples rather than wall clock, so the
+    result only depends on the audio. Speech starts above `speech_threshold`
+    and silence below `silence_threshold`, probabilities in between keep the
+    current state.
+    With `adaptive` set, the trailing silence needed to finish grows from
+    `min_silence` to `max_silence` over the first `adaptive_span` seconds of
+    speech: short commands end quickly, longer sentences may pause.
+
+    Args:
+        silence_delay (float): Seconds of silence after speech that end the utterance
+        wait_for_speech (float): Seconds to wait for speech to start before giving up
+    """
+
+    def __init__(self, rate=16000, silence_delay=1.0, wait_for_speech=4.0,
+                 speech_threshold=0.5, silence_threshold=0.4,
+                 adaptive=False, min_silence=0.5, max_silence=1.5, adaptive_span=5.0):
+        self.rate = rate
+        self.silence_delay = silence_delay
+        self.wait_for_speech = wait_for_speech
+        self.speech_threshold = speech_threshold
+        self.silence_threshold = silence_threshold
+        self.adaptive = adaptive
+        self.min_silence = min_silence
+        self.max_silence = max_silence
+        self.adaptive_span = adaptive_span
+        self.state = IDLE
+        self.samples = 0
+        self.timeout = 0
+        self.speech_start = 0
+        self.silence_start = 0
+
+    @property
+    def active(self):
+        return self.state != IDLE
+
+    @property
+    def speech_detected(self):
+        return self.state in (SPEAKING, TRAILING)
+
+    def start(self, timeout=None):
+        """Starts waiting for speech, `timeout` overrides wait_for_speech"""
+        self.samples = 0
+        self.timeout = int((self.wait_for_speech if timeout is None else timeout) * self.rate)
+        self.state = WAITING
+
+    def stop(self):
+        self.state = IDLE
+
+    def trailing_silence(self):
+        """Samples of silence needed to finish the current utterance"""
+        if not self.adaptive:
+            return int(self.silence_delay * self.rate)
+        spoken = (self.silence_start - self.speech_start) / self.rate
+        progress = min(spoken / self.adaptive_span, 1.0) if self.adaptive_span > 0 else 1.0
+        return int((self.min_silence + (self.max_silence - self.min_silence) * progress) * self.rate)
+
+    def update(self, probability, samples):
+        """
+        Feeds the VAD probability of the next `samples` samples.
+        Returns NO_SPEECH or FINISHED when the utterance ends, otherwise None
+        """
+        if self.state == IDLE:
+            return None
+        self.samples += samples
+
+        if probability > self.speech_threshold:
+            if self.state == WAITING:
+                self.speech_start = self.samples - samples
+            self.state = SPEAKING
+        elif self.state == WAITING:
+            if self.samples >= self.timeout:
+                self.state = IDLE
+                return NO_SPEECH
+        elif self.state == SPEAKING and probability < self.silence_threshold:
+            self.state = TRAILING
+            self.silence_start = self.samples - samples
+
+        if self.state == TRAILING and self.samples - self.silence_start >= self.trailing_silence():
+            self.state = IDLE
+            return FINISHED
+        return None
@@ -0,0 +1,164 @@
+"""
+Chooses the wake word inference engine and thread count for this board.
+
+models/ ships most wake words both as .tflite and .onnx, which one runs
+faster depends on the CPU. With INFERENCE_ENGINE=auto every available
+framework and thread count is timed on a short clip at first boot, the
+fastest one whose scores stay within ENGINE_TOLERANCE of the tflite
+single thread reference wins, and the choice is cached in ENGINE_CACHE
+until the board, the models or the settings change.
+
+    python engine.py Mahvareek,ahtlahz    # re-run the benchmark and print it
+"""
+import importlib.util
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+import logger
+from config import config
+from frames import FRAME_SAMPLES
+
+log = logger.get(__name__)
+
+# tflite, onnx or auto
+INFERENCE_ENGINE = config.get('INFERENCE_ENGINE', 'auto')
+# Threads for the shared feature models, 0 picks them with the engine
+INFERENCE_THREADS = int(config.get('INFERENCE_THREADS', 0))
+# Largest per chunk score difference to the reference an engine may have
+ENGINE_TOLERANCE = float(config.get('ENGINE_TOLERANCE', 0.05))
+ENGINE_CACHE = config.get('ENGINE_CACHE', '.engine.json')
+ENGINE_BENCHMARK_WAV = config.get('ENGINE_BENCHMARK_WAV', 'audio.wav')
+ENGINE_BENCHMARK_SECONDS = float(config.get('ENGINE_BENCHMARK_SECONDS', 3))
+
+MODELS_DIR = 'models'
+TFLITE = 'tflite'
+ONNX = 'onnx'
+FRAMEWORKS = (TFLITE, ONNX)
+_RUNTIMES = {TFLITE: ('tflite_runtime', 'tensorflow', 'ai_edge_litert'), ONNX: ('onnxruntime',)}
+
+
+def model_paths(names, framework):
+    return [os.path.join(MODELS_DIR, f'{name}.{framework}') for name in names]
+
+
+def available(names, framework):
+    """Whether the runtime is installed and every wake word has a model for it"""
+    if not any(importlib.util.find_spec(module) for module in _RUNTIMES[framework]):
+        return False
+    return all(os.path.exists(path) for path in model_paths(names, framework))
+
+
+def candidates(names):
+    """(framework, threads) pairs worth timing, the reference first"""
+    cpus = os.cpu_count() or 1
+    threads = sorted({1, min(2, cpus), cpus}) if not INFERENCE_THREADS else [INFERENCE_THREADS]
+    frameworks = FRAMEWORKS if INFERENCE_ENGINE == 'auto' else (INFERENCE_ENGINE,)
+    return [(framework, n) for framework in frameworks if available(names, framework) for n in threads]
+
+
+def _cache_key(names):
+    files = {}
+    for framework in FRAMEWORKS:
+        for path in model_paths(names, framework):
+            if os.path.exists(path):
+                stat = os.stat(path)
+                files[path] = [stat.st_size, int(stat.st_mtime)]
+    return {
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'engine': INFERENCE_ENGINE,
+        'threads': INFERENCE_THREADS,
+        'tolerance': ENGINE_TOLERANCE,
+        'files': files,
+    }
+
+
+def _benchmark_audio():
+    from earcons import decode_wav
+
+    samples = decode_wav(ENGINE_BENCHMARK_WAV) if os.path.exists(ENGINE_BENCHMARK_WAV) else np.zeros(0, np.int16)
+    length = int(ENGINE_BENCHMARK_SECONDS * 16000)
+    if not len(samples):
+        samples = np.random.default_rng(0).normal(0, 500, length).astype(np.int16)
+    return np.resize(samples, max(length, FRAME_SAMPLES))
+
+
+def measure(names, framework, threads, audio):
+    """Returns the median chunk latency in seconds and the scores per chunk"""
+    from inference import _load_wake_word_model
+
+    model = _load_wake_word_model(model_paths(names, framework), framework, threads)
+    chunks = [audio[i:i + FRAME_SAMPLES] for i in range(0, len(audio) - FRAME_SAMPLES + 1, FRAME_SAMPLES)]
+    model.predict(chunks[0])
+    model.reset()
+    durations = []
+    scores = []
+    for chunk in chunks:
+        start = time.perf_counter()
+        prediction = model.predict(chunk)
+        durations.append(time.perf_counter() - start)
+        scores.append([prediction[name] for name in names])
+    return float(np.median(durations)), np.array(scores)
+
+
+def benchmark(names):
+    """Times every candidate, returns them fastest first with their accuracy check"""
+    audio = _benchmark_audio()
+    results = []
+    reference = None
+    for framework, threads in candidates(names):
+        try:
+            latency, scores = measure(names, framework, threads, audio)
+        except Exception as e:
+            log.warning(f'Engine {framework} with {threads} threads failed: {e}')
+            continue
+        if reference is None:
+            reference = scores
+        error = float(np.abs(scores - reference).max()) if scores.shape == reference.shape else float('inf')
+        results.append({'framework': framework, 'threads': threads, 'latency_ms': latency * 1000,
+                        'max_score_error': error, 'accurate': error <= ENGINE_TOLERANCE})
+    return sorted(results, key=lambda r: r['latency_ms'])
+
+
+def select(names):
+    """Returns (framework, threads) for the given wake words, benchmarking on the first call"""
+    if INFERENCE_ENGINE != 'auto' and INFERENCE_THREADS:
+        return INFERENCE_ENGINE, INFERENCE_THREADS
+
+    key = _cache_key(names)
+    cached = {}
+    try:
+        with open(ENGINE_CACHE) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        pass
+    if cached.get('key') == key:
+        return cached['framework'], cached['threads']
+
+    start = time.perf_counter()
+    results = benchmark(names)
+    accurate = [r for r in results if r['accurate']]
+    if not accurate:
+        log.warning('No engine could be benchmarked, using tflite with 1 thread')
+        return TFLITE, INFERENCE_THREADS or 1
+    choice = accurate[0]
+    log.info(f'Engine benchmark took {time.perf_counter() - start:.1f} s, using {choice["framework"]} '
+             f'with {choice["threads"]} threads: ' +
+             ', '.join(f'{r["framework"]}/{r["threads"]} {r["latency_ms"]:.2f} ms' for r in results))
+    try:
+        with open(ENGINE_CACHE, 'w') as f:
+            json.dump({'key': key, 'framework': choice['framework'], 'threads': choice['threads'],
+                       'results': results}, f, indent=2)
+    except OSError as e:
+        log.warning(f'Can not write {ENGINE_CACHE}: {e}')
+    return choice['framework'], choice['threads']
+
+
+if __name__ == '__main__':
+    wake_words = (sys.argv[1] if len(sys.argv) > 1 else config.get('WAKE_WORD_MODEL')).split(',')
+    print(json.dumps(benchmark(wake_words), indent=2))
@@ -0,0 +1,100 @@
+"""
+Pooled audio frames, so the steady state capture path does not allocate.
+
+A Frame owns a preallocated int16 buffer and exposes it as a memoryview of
+bytes (for the VAD, ring buffers and the network) and as a NumPy int16 view
+(for the wake word model) without copying. The float32 version and the RMS
+are computed at most once per fill and shared by every consumer.
+"""
+from collections import deque
+
+import numpy as np
+
+from utils_vad import int2float
+
+# Samples per frame the runner feeds the models, 32 ms at 16 kHz.
+# Offline tools score audio in frames of this size too, so their results carry over
+FRAME_SAMPLES = 512
+
+
+class Frame(object):
+    __slots__ = ('pool', 'buffer', 'view', 'samples', 'floats', 'length', 'captured', '_float_ready', '_rms')
+
+    def __init__(self, pool, size):
+        self.pool = pool
+        self.buffer = bytearray(size * 2)
+        self.view = memoryview(self.buffer)
+        self.samples = np.frombuffer(self.buffer, dtype=np.int16)
+        self.floats = np.empty(size, dtype=np.float32)
+        self.length = 0
+        self.captured = 0.0
+        self._float_ready = False
+        self._rms = None
+
+    def __len__(self):
+        """Length in bytes, like the chunks read from a stream"""
+        return self.length * 2
+
+    def filled(self, nbytes, captured=0.0):
+        """Marks the first nbytes of the buffer as new audio"""
+        self.length = nbytes // 2
+        self.captured = captured
+        self._float_ready = False
+        self._rms = None
+        return self
+
+    def fill(self, data, captured=0.0):
+        """Copies bytes into the frame, for sources that can not read into it"""
+        n = min(len(data), len(self.buffer))
+        self.view[:n] = memoryview(data).cast('B')[:n]
+        return self.filled(n, captured)
+
+    @property
+    def data(self):
+        """The audio as a memoryview of bytes, valid until the frame is released"""
+        return self.view[:self.length * 2]
+
+    @property
+    def int16(self):
+        return self.samples[:self.length]
+
+    @property
+    def float32(self):
+        """Samples scaled to [-1, 1), converted on first use"""
+        if not self._float_ready:
+            int2float(self.int16, out=self.floats[:self.length])
+            self._float_ready = True
+        return self.floats[:self.length]
+
+    @property
+    def rms(self):
+        """RMS in int16 units, computed once"""
+        if self._rms is None:
+            floats = self.float32
+            self._rms = float(np.sqrt(np.dot(floats, floats) / max(self.length, 1))) * 32768
+        return self._rms
+
+    def release(self):
+        self.pool.release(self)
+
+
+class FramePool(object):
+    """
+    Hands out frames of `size` samples. Released frames are reused, the pool
+    only grows when more than `count` frames are held at once
+    """
+
+    def __init__(self, size, count=4):
+        self.size = size
+        self.free = deque(Frame(self, size) for _ in range(count))
+        self.allocated = count
+
+    def acquire(self):
+        try:
+            return self.free.pop()
+        except IndexError:
+            self.allocated += 1
+            return Frame(self, self.size)
+
+    def release(self, frame):
+        self.free.append(frame)
@@ -0,0 +1,119 @@
+from collections import deque
+
+import numpy as np
+
+from tracing import tracer
+
+OFF = 'off'
+ENERGY = 'energy'
+VAD = 'vad'
+# Counters are published as tracer gauges every this many chunks, about 1 s
+PUBLISH_CHUNKS = 32
+
+
+class EnergyGate(object):
+    """
+    Decides which chunks are worth running the wake word model on.
+
+    Tracks the noise floor of the room from the RMS of quiet chunks and opens
+    when a chunk is `ratio` times louder than that floor. While closed only
+    every `decimation`-th chunk is inferred. Skipped chunks are remembered, and
+    the last `lookback` of them are replayed through the model when the gate
+    opens, so the model's feature buffers hold contiguous audio again before
+    the loud chunk is scored.
+    Optionally a VAD callable has to confirm speech before the gate opens.
+    The counters and noise floor show up as wake_gate_* tracer gauges.
+    """
+
+    def __init__(self, ratio=3.0, min_rms=100.0, hangover=16, decimation=4, lookback=4,
+                 vad=None, vad_threshold=0.3):
+        self.ratio = ratio
+        self.min_rms = min_rms
+        self.hangover = hangover
+        self.decimation = max(decimation, 1)
+        self.vad = vad
+        self.vad_threshold = vad_threshold
+        self.noise_floor = min_rms
+        self.open_chunks = 0
+        self.closed_chunks = 0
+        self.skipped = deque(maxlen=lookback)
+        # Skipped chunks are copied into these preallocated rows instead of new arrays
+        self.history = None
+        self.next_row = 0
+        self.counters = {'inferred': 0, 'skipped': 0, 'replayed': 0, 'opened': 0, 'vad_rejected': 0}
+        self.updates = 0
+
+    @staticmethod
+    def rms(frame):
+        samples = frame.astype(np.float32)
+        return float(np.sqrt(np.dot(samples, samples) / max(len(samples), 1)))
+
+    def _track_floor(self, rms):
+        # Follow drops quickly and rises slowly, so speech does not lift the floor
+        rate = 0.2 if rms < self.noise_floor else 0.01
+        self.noise_floor = max(self.noise_floor + (rms - self.noise_floor) * rate, 1.0)
+
+    def _is_loud(self, frame, rms):
+        if rms < max(self.min_rms, self.noise_floor * self.ratio):
+            return False
+        if self.vad is not None and self.open_chunks == 0:
+            if self.vad(frame.tobytes()) < self.vad_threshold:
+                self.counters['vad_rejected'] += 1
+                return False
+        return True
+
+    def _remember(self, frame):
+        if not self.skipped.maxlen:
+            return
+        if self.history is None or self.history.shape[1] != len(frame):
+            self.history = np.empty((self.skipped.maxlen, len(frame)), dtype=frame.dtype)
+        row = self.history[self.next_row]
+        self.next_row = (self.next_row + 1) % len(self.history)
+        # The row being overwritten is the oldest one in `skipped`, which the append drops
+        row[:] = frame
+        self.skipped.append(row)
+
+    def update(self, frame, rms=None):
+        """
+        Returns the frames that should be passed to the model, oldest first.
+        Replayed frames are only valid until the next update
+        """
+        rms = self.rms(frame) if rms is None else rms
+        self.updates += 1
+        if self.updates % PUBLISH_CHUNKS == 0:
+            self.publish()
+        if self._is_loud(frame, rms):
+            frames = []
+            if self.open_chunks == 0:
+                self.counters['opened'] += 1
+                frames.extend(self.skipped)
+                self.counters['replayed'] += len(self.skipped)
+            self.open_chunks = self.hangover
+        elif self.open_chunks > 0:
+            self.open_chunks -= 1
+            frames = []
+        else:
+            self._track_floor(rms)
+            self.closed_chunks += 1
+            if self.closed_chunks % self.decimation:
+                self._remember(frame)
+                self.counters['skipped'] += 1
+                return []
+            frames = []
+
+        self.skipped.clear()
+        frames.append(frame)
+        self.counters['inferred'] += 1
+        return frames
+
+    def reset(self):
+        self.open_chunks = 0
+        self.closed_chunks = 0
+        self.skipped.clear()
+
+    def stats(self):
+        return {**self.counters, 'noise_floor': self.noise_floor}
+
+    def publish(self):
+        for name, value in self.stats().items():
+            tracer.gauge(f'wake_gate_{name}', value)
@@ -0,0 +1,202 @@
+import multiprocessing
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Connection
+
+import numpy as np
+
+import logger
+from frames import FRAME_SAMPLES
+
+log = logger.get(__name__)
+
+PREDICT = 'predict'
+VAD = 'vad'
+READY = 'ready'
+FAILED = 'failed'
+
+
+def _timed(timings, phase, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings[phase] = time.perf_counter() - start
+    return result
+
+
+def _load_wake_word_model(wakewords, inference_framework, threads=1):
+    import model_store
+    from openwakeword.model import Model
+
+    model_store.ensure_feature_models()
+    model_store.verify([path for path in wakewords if path.startswith(model_store.MODELS_DIR)])
+    # ncpu sets the threads of the shared melspectrogram and embedding models,
+    # which take most of the time per chunk
+    return Model(wakewords, inference_framework=inference_framework, ncpu=threads)
+
+
+def _load_vad_model():
+    from pysilero_vad import SileroVoiceActivityDetector
+    return SileroVoiceActivityDetector()
+
+
+class LocalInference(object):
+    """
+    Runs the wake word model and the VAD in the calling thread.
+    Both models are loaded in parallel and warmed up with a silent chunk,
+    so the first real chunk does not pay for lazy initialization.
+    Load times per phase are kept in `timings`
+    """
+
+    def __init__(self, wakewords, inference_framework='tflite', chunk_size=FRAME_SAMPLES, threads=1):
+        self.timings = {}
+        with ThreadPoolExecutor(2) as pool:
+            model = pool.submit(_timed, self.timings, 'wake_word_load', _load_wake_word_model,
+                                wakewords, inference_framework, threads)
+            vad_model = pool.submit(_timed, self.timings, 'vad_load', _load_vad_model)
+            self.model = model.result()
+            self.vad_model = vad_model.result()
+        # pysilero-vad 3 takes float samples with process_samples, 2.x with process_array
+        self.vad_samples = getattr(self.vad_model, 'process_samples', None) or \
+            getattr(self.vad_model, 'process_array', None)
+
+        silence = np.zeros(chunk_size, dtype=np.int16)
+        _timed(self.timings, 'warmup', self._warmup, silence)
+
+    def _warmup(self, silence):
+        self.model.predict(silence)
+        self.vad_model(silence.tobytes())
+        self.model.reset()
+
+    def predict(self, frame):
+        return self.model.predict(frame)
+
+    def vad(self, chunk):
+        """Speech probability of one frame, given as int16 bytes or as float32 samples in [-1, 1)"""
+        if isinstance(chunk, np.ndarray) and chunk.dtype == np.float32:
+            if self.vad_samples is not None:
+                return self.vad_samples(chunk)
+            chunk = (chunk * 32768).astype(np.int16)
+        # The VAD parses its input with array('h', ...), which reads a byte memoryview byte by byte
+        return self.vad_model(bytes(chunk))
+
+    def reset(self):
+        self.model.reset()
+
+    def close(self):
+        pass
+
+
+def _serve(conn):
+    logger.use_stderr()
+    shm_name, slots, chunk_size, wakewords, inference_framework, threads = conn.recv()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    # The parent owns the segment, this process' resource tracker must not unlink it on exit
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    frames = np.ndarray((slots, chunk_size), dtype=np.int16, buffer=shm.buf)
+    frame = None
+    try:
+        try:
+            engine = LocalInference(wakewords, inference_framework, chunk_size, threads)
+        except Exception as e:
+            log.exception('Loading the models failed')
+            conn.send((FAILED, f'{type(e).__name__}: {e}'))
+            return
+        conn.send((READY, engine.timings))
+        while True:
+            job = conn.recv()
+            if job is None:
+                break
+            kind, slot, length = job
+            frame = frames[slot, :length]
+            if kind == PREDICT:
+                conn.send(engine.predict(frame))
+            elif kind == VAD:
+                conn.send(engine.vad(frame.tobytes()))
+            else:
+                engine.reset()
+                conn.send(None)
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        del frame, frames
+        shm.close()
+
+
+class ProcessInference(object):
+    """
+    Runs the wake word model and the VAD in a worker process, so inference
+    does not hold the GIL shared with the asyncio loop.
+    Frames are passed through a shared memory ring, only slot indices and
+    results go over the pipe. Each call waits for its result, which keeps
+    the same ordering as LocalInference.
+    The worker is a new interpreter running this file, not a fork: the models
+    load while PortAudio, zmq and logging threads run, and a forked child
+    could inherit their locks held. Spawning through multiprocessing would
+    re-import app.py with its module level audio and zmq setup instead
+    """
+
+    def __init__(self, wakewords, inference_framework='tflite', chunk_size=FRAME_SAMPLES, slots=8, threads=1):
+        self.chunk_size = chunk_size
+        self.slots = slots
+        self.slot = 0
+        self.shm = shared_memory.SharedMemory(create=True, size=slots * chunk_size * 2)
+        self.frames = np.ndarray((slots, chunk_size), dtype=np.int16, buffer=self.shm.buf)
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = subprocess.Popen([sys.executable, __file__, str(child_conn.fileno())],
+                                        pass_fds=(child_conn.fileno(),))
+        child_conn.close()
+        self.conn.send((self.shm.name, slots, chunk_size, wakewords, inference_framework, threads))
+        try:
+            ready, self.timings = self.conn.recv()
+        except (EOFError, OSError) as e:
+            ready, self.timings = None, e
+        if ready != READY:
+            self.close()
+            raise RuntimeError(f'Inference process failed to start: {self.timings}')
+        log.info(f'Inference process started, pid {self.process.pid}')
+
+    def _call(self, kind, samples):
+        samples = samples[:self.chunk_size]
+        slot = self.slot
+        self.slot = (self.slot + 1) % self.slots
+        self.frames[slot, :len(samples)] = samples
+        self.conn.send((kind, slot, len(samples)))
+        return self.conn.recv()
+
+    def predict(self, frame):
+        return self._call(PREDICT, frame)
+
+    def vad(self, chunk):
+        if isinstance(chunk, np.ndarray) and chunk.dtype == np.float32:
+            # Back to the int16 slots, exact for samples scaled by 1/32768 like frames.Frame.float32
+            return self._call(VAD, chunk * 32768)
+        return self._call(VAD, np.frombuffer(chunk, dtype=np.int16))
+
+    def reset(self):
+        self.conn.send(('reset', 0, 0))
+        self.conn.recv()
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        try:
+            self.process.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            self.process.terminate()
+        self.process = None
+        self.conn.close()
+        del self.frames
+        self.shm.close()
+        self.shm.unlink()
+
+
+if __name__ == '__main__':
+    # Worker started by ProcessInference, the argument is its end of the pipe
+    _serve(Connection(int(sys.argv[1])))
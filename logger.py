@@ -1,18 +1,113 @@
+"""
+Non-blocking logging setup.
+
+Loggers only put records on a queue; a background listener thread formats
+them and writes to stdout and the rotating logs.log, so a slow SD card or a
+log rotation never stalls the capture or playback threads.
+Pass structured fields with `extra=fields(key=value)`, they are appended as
+key=value pairs, or emitted as JSON lines with LOG_FORMAT=json.
+Throttle limits how often per chunk diagnostics are logged.
+"""
+import atexit
+import json
 import logging
+import queue
 import sys
+import time
 from logging import handlers
+from threading import Lock
+
+from config import config
+
+LOG_LEVEL = config.get('LOG_LEVEL', 'INFO').upper()
+# text or json
+LOG_FORMAT = config.get('LOG_FORMAT', 'text')
+LOG_FILE = config.get('LOG_FILE', 'logs.log')
+
+
+def fields(**kwargs):
+    """Structured fields for a record: log.info('Activation', extra=fields(word='alexa', score=0.9))"""
+    return {'fields': kwargs}
+
+
+class Formatter(logging.Formatter):
+    def format(self, record):
+        message = super().format(record)
+        extra = getattr(record, 'fields', None)
+        if extra:
+            message += ' ' + ' '.join(f'{key}={value}' for key, value in extra.items())
+        return message
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            'ts': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+            **getattr(record, 'fields', {}),
+        }
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
 
-log = logging.getLogger('')
-log.setLevel(logging.INFO)
-format = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+class Throttle(object):
+    """
+    Lets an event through at most once per `interval` seconds per key.
+    Calling it returns None when the event should be dropped, otherwise
+    the number of events dropped since the last one that went through
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.lock = Lock()
+        self.last = {}
+        self.skipped = {}
+
+    def __call__(self, key=None):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last.get(key, -self.interval) < self.interval:
+                self.skipped[key] = self.skipped.get(key, 0) + 1
+                return None
+            self.last[key] = now
+            return self.skipped.pop(key, 0)
+
+
+if LOG_FORMAT == 'json':
+    format = JsonFormatter()
+else:
+    format = Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
 ch = logging.StreamHandler(sys.stdout)
 ch.setFormatter(format)
-log.addHandler(ch)
 
-fh = handlers.RotatingFileHandler("logs.log", maxBytes=(1048576 * 5), backupCount=7)
+fh = handlers.RotatingFileHandler(LOG_FILE, maxBytes=(1048576 * 5), backupCount=7)
 fh.setFormatter(format)
-log.addHandler(fh)
+
+log = logging.getLogger('')
+log.setLevel(LOG_LEVEL)
+log.addHandler(handlers.QueueHandler(queue.SimpleQueue()))
+listener = handlers.QueueListener(log.handlers[0].queue, ch, fh, respect_handler_level=True)
+listener.start()
+# Flushes what is still queued on exit
+atexit.register(listener.stop)
+
+
+def use_stderr():
+    """
+    For worker processes: logs straight to stderr, without the listener
+    thread and without writing to the parent's log file
+    """
+    atexit.unregister(listener.stop)
+    listener.stop()
+    fh.close()
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(format)
+    log.handlers = [handler]
 
 
 def get(name):
@@ -2,10 +2,10 @@ import asyncio
 import audioop
 import math
 import os
+import queue
 import struct
 import time
-from threading import Timer
-import wave
+from threading import Lock, Thread, Timer
 from collections import deque
 from openwakeword.model import Model
 
@@ -17,11 +17,13 @@ CHUNK = 512
 FORMAT = pyaudio.paInt16
 CHANNELS = 1
 RATE = 16000
-recorded_wav_path = 'audio.wav'
 speech_record_gap = 1
 silence_limit = 1
 silence_threshold = 1.5  # sec
 speech_recognition_server_url = os.getenv('ASSISTANT_ENDPOINT')
+# Recording is finished after this long even if the user keeps talking
+max_record_seconds = 15
+upload_boundary = 'voice-client-audio'
 rel = RATE / CHUNK
 frames = []
 
@@ -29,7 +31,10 @@ slid_window = deque(maxlen=int(silence_limit * rel))
 
 wake_word_detected = False
 speech_detected = False
-wav_file: wave.Wave_write
+recorded_samples = 0
+upload = None
+# upload is replaced by the loop and cleared by callbacks on Timer threads
+upload_lock = Lock()
 
 p = pyaudio.PyAudio()
 info = p.get_host_api_info_by_index(0)
@@ -47,8 +52,68 @@ stream = p.open(format=FORMAT,
 
 
 
+class UploadAborted(Exception):
+    pass
+
+
+class StreamingUpload(Thread):
+    """
+    Posts the recording while it is being made, as a multipart form with
+    chunked transfer encoding, and plays the response once it is finished
+    """
+    ABORT = object()
+
+    def __init__(self, url):
+        super().__init__(daemon=True)
+        self.url = url
+        self.chunks = queue.Queue()
+        self.finished_at = None
+
+    def write(self, data):
+        self.chunks.put(data)
+
+    def finish(self):
+        self.finished_at = time.time()
+        self.chunks.put(None)
+
+    def abort(self):
+        self.chunks.put(self.ABORT)
+
+    def _body(self):
+        yield (f'--{upload_boundary}\r\n'
+               'Content-Disposition: form-data; name="audio"; filename="audio.wav"\r\n'
+               'Content-Type: audio/wav\r\n\r\n').encode()
+        # Sizes are unknown while streaming, 0xFFFFFFFF is the usual placeholder
+        yield struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 0xFFFFFFFF, b'WAVE', b'fmt ', 16, 1, CHANNELS,
+                          RATE, RATE * 2 * CHANNELS, 2 * CHANNELS, 16, b'data', 0xFFFFFFFF)
+        while True:
+            data = self.chunks.get()
+            if data is None:
+                break
+            if data is self.ABORT:
+                raise UploadAborted()
+            yield data
+        yield f'\r\n--{upload_boundary}--\r\n'.encode()
+
+    def run(self):
+        try:
+            r = requests.post(self.url, data=self._body(),
+                              headers={'Accept': '*/*',
+                                       'Content-Type': f'multipart/form-data; boundary={upload_boundary}'})
+        except UploadAborted:
+            print('Upload aborted')
+            return
+        except requests.RequestException as e:
+            print(f'Upload failed: {e}')
+            return
+        print(f"Request time after finish: {time.time() - self.finished_at}")
+        with open('response.wav', 'wb') as f:
+            f.write(r.content)
+        play_sound('response.wav')
+
+
 async def main():
-    global wake_word_detected, speech_detected, wav_file
+    global wake_word_detected, speech_detected, recorded_samples
     false_speech_timer = Timer(5, false_speech_callback)
     finish_speech_timer = Timer(silence_threshold, lambda: print("finish speech"))
     # Timer(0, play_sound, ['sounds/boot.wav']).start()
@@ -66,11 +131,19 @@ async def main():
             false_speech_timer = Timer(5, false_speech_callback)
             false_speech_timer.start()
             Timer(0, play_sound, ['sounds/click.wav']).start()
-            init_wav()
+            start_upload()
 
         if wake_word_detected:
-            if wav_file is not None:
-                wav_file.writeframes(struct.pack("h" * len(data), *data))
+            current = upload
+            if current is not None:
+                current.write(data)
+            recorded_samples += len(data) // 2
+            if recorded_samples >= max_record_seconds * RATE:
+                print(f'Recording reached {max_record_seconds} seconds')
+                false_speech_timer.cancel()
+                finish_speech_timer.cancel()
+                finish_speech_callback()
+                continue
 
             frame = np.frombuffer(data, dtype=np.int16)
             voice_probability = np.abs(frame).mean()
@@ -84,47 +157,48 @@ async def main():
                 finish_speech_timer.start()
 
 
-def init_wav():
-    global wav_file
-    wav_file = wave.open(recorded_wav_path, "w")
-    wav_file.setnchannels(1)
-    wav_file.setsampwidth(2)
-    wav_file.setframerate(16000)
+def start_upload():
+    """Starts posting the recording right at the wake word, so it is mostly sent by the end of speech"""
+    global upload, recorded_samples
+    recorded_samples = 0
+    current = StreamingUpload(speech_recognition_server_url)
+    current.start()
+    with upload_lock:
+        upload = current
+
+
+def take_upload():
+    """Detaches the running upload, so only one callback finishes or aborts it"""
+    global upload
+    with upload_lock:
+        current, upload = upload, None
+    return current
 
 
 def false_speech_callback():
     global wake_word_detected
     wake_word_detected = False
+    current = take_upload()
+    if current is not None:
+        current.abort()
     print("Speech was not detected, after 5 seconds")
 
 
 def finish_speech_callback():
     global wake_word_detected
     global speech_detected
-    global wav_file
     print(f'Silence timeout. Speech detected: {speech_detected}')
     wake_word_detected = False
 
-    if wav_file is not None:
-        wav_file.close()
-        wav_file = None
+    current = take_upload()
+    if current is not None:
         if speech_detected:
-            request()
+            current.finish()
+        else:
+            current.abort()
     speech_detected = False
 
 
-def request():
-    start = time.time()
-    file = {'audio': open(recorded_wav_path, 'rb')}
-    r = requests.post(speech_recognition_server_url, files=file, headers={'Accept': '*/*'})
-    print(f"Request time: {time.time() - start}")
-    start = time.time()
-    with open('response.wav', 'wb') as f:
-        f.write(r.content)
-        print(f"Decode time: {time.time() - start}")
-        play_sound('response.wav')
-
-
 def play_sound(sound_path):
     print(f'Play {sound_path}')
     os.system(f'aplay {sound_path}')
@@ -0,0 +1,109 @@
+"""
+Checks that wake word models are present and intact without going to the network.
+
+models/manifest.json lists the sha256 of every bundled model. Hashes of files
+that were already verified are cached by size and mtime in .model_cache.json,
+so a restart only stats the files. openWakeWord's shared feature models are
+only downloaded when they are missing.
+
+    python model_store.py    # regenerate models/manifest.json
+"""
+import glob
+import hashlib
+import json
+import os
+
+import logger
+from config import config
+
+log = logger.get(__name__)
+
+MODELS_DIR = 'models'
+MANIFEST = os.path.join(MODELS_DIR, 'manifest.json')
+HASH_CACHE = config.get('MODEL_HASH_CACHE', '.model_cache.json')
+# Allow downloading openWakeWord feature models when they are missing
+MODEL_DOWNLOAD = config.get('MODEL_DOWNLOAD', 'true').lower() in ('1', 'true', 'yes')
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json(path, data):
+    try:
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+    except OSError as e:
+        log.warning(f'Can not write {path}: {e}')
+
+
+def sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def verify(paths):
+    """Raises ValueError when a model is missing or does not match the manifest"""
+    manifest = _read_json(MANIFEST)
+    cache = _read_json(HASH_CACHE)
+    changed = False
+    for path in paths:
+        if not os.path.exists(path):
+            raise ValueError(f'Model {path} does not exist')
+        name = os.path.basename(path)
+        expected = manifest.get(name)
+        if expected is None:
+            log.warning(f'Model {path} is not listed in {MANIFEST}')
+            continue
+        stat = os.stat(path)
+        key = [stat.st_size, stat.st_mtime_ns]
+        cached = cache.get(path)
+        if cached and cached[:2] == key:
+            digest = cached[2]
+        else:
+            digest = sha256(path)
+            cache[path] = key + [digest]
+            changed = True
+        if digest != expected:
+            raise ValueError(f'Model {path} does not match {MANIFEST}')
+    if changed:
+        _write_json(HASH_CACHE, cache)
+
+
+def ensure_feature_models():
+    """Downloads openWakeWord's melspectrogram and embedding models only if they are missing"""
+    import openwakeword
+    import openwakeword.utils
+
+    for feature in openwakeword.FEATURE_MODELS.values():
+        for extension in ('.tflite', '.onnx'):
+            path = feature['model_path'].replace('.tflite', extension)
+            if os.path.exists(path):
+                continue
+            if not MODEL_DOWNLOAD:
+                raise ValueError(f'Missing openWakeWord feature model {path}')
+            log.info(f'Downloading missing openWakeWord model {path}')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            openwakeword.utils.download_file(feature['download_url'].replace('.tflite', extension),
+                                             os.path.dirname(path))
+
+
+def write_manifest():
+    manifest = {
+        os.path.basename(path): sha256(path)
+        for path in sorted(glob.glob(os.path.join(MODELS_DIR, '*')))
+        if os.path.basename(path) != os.path.basename(MANIFEST)
+    }
+    _write_json(MANIFEST, manifest)
+    return manifest
+
+
+if __name__ == '__main__':
+    log.info(f'Wrote {len(write_manifest())} models to {MANIFEST}')
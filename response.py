@@ -0,0 +1,92 @@
+"""
+Playback of the router's streamed answer, with barge-in.
+
+SPEAK frames belong to a response stream, identified by the `stream_id`
+parameter when the router sends one and otherwise by the FINISH that asked
+for it. The first frame of a stream starts output right away instead of
+waiting for the jitter buffer to fill. Frames that arrive faster than real
+time and would overflow the jitter buffer wait here and are passed on as it
+drains, so a long answer is never cut. interrupt() silences the current
+stream at once, drops its remaining frames and returns the CLEAR parameters
+that tell the router to stop generating it.
+"""
+import asyncio
+import json
+import time
+from collections import deque
+
+import logger
+
+log = logger.get(__name__)
+
+# A stream that sent nothing for this long and has played out is over
+RESPONSE_IDLE = 1.0  # seconds
+# How often frames waiting for room in the jitter buffer are retried
+RESPONSE_DRAIN_INTERVAL = 0.1  # seconds
+
+
+class ResponseStream(object):
+    def __init__(self, audio):
+        self.audio = audio
+        self.stream_id = None
+        self.frames = 0
+        self.last_frame = 0.0
+        self.accepting = True
+        self.cancelled = set()
+        self.dropped = 0
+        # (frame, start) waiting for room in the jitter buffer
+        self.pending = deque()
+        self.draining = None
+
+    def expect(self):
+        """Called when a new answer was asked for, e.g. after FINISH"""
+        self.accepting = True
+        self.frames = 0
+
+    def on_speak(self, params, frame):
+        stream_id = (params or {}).get('stream_id')
+        if stream_id in self.cancelled or (stream_id is None and not self.accepting):
+            self.dropped += 1
+            return
+        if stream_id != self.stream_id:
+            self.stream_id = stream_id
+            self.frames = 0
+        self.accepting = True
+        self.pending.append((frame, self.frames == 0))
+        self.frames += 1
+        self.last_frame = time.monotonic()
+        self._drain()
+
+    def _drain(self):
+        """Moves waiting frames into the jitter buffer while they fit, called on the event loop"""
+        self.draining = None
+        while self.pending and len(self.pending[0][0]) <= self.audio.room():
+            frame, start = self.pending.popleft()
+            self.audio.play(frame, start=start)
+        if self.pending:
+            self.draining = asyncio.get_running_loop().call_later(RESPONSE_DRAIN_INTERVAL, self._drain)
+
+    @property
+    def active(self):
+        return self.frames > 0 and (bool(self.pending) or self.audio.busy or
+                                    time.monotonic() - self.last_frame < RESPONSE_IDLE)
+
+    def interrupt(self):
+        """
+        Stops the answer being played, returns the CLEAR parameters to send
+        to the router, or None when nothing was playing
+        """
+        if not self.active:
+            return None
+        self.pending.clear()
+        if self.draining:
+            self.draining.cancel()
+            self.draining = None
+        self.audio.flush()
+        if self.stream_id is not None:
+            self.cancelled.add(self.stream_id)
+        self.accepting = False
+        log.info(f'Barge-in on stream {self.stream_id} after {self.frames} frames')
+        params = {'stream_id': self.stream_id} if self.stream_id is not None else {}
+        self.frames = 0
+        return json.dumps(params).encode()
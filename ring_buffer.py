@@ -0,0 +1,161 @@
+import time
+from enum import Enum
+from threading import Condition
+
+
+class Overflow(Enum):
+    DROP_OLDEST = 'drop'
+    BLOCK = 'block'
+    RAISE = 'raise'
+
+
+class RingBuffer(object):
+    """
+    Fixed capacity byte ring backed by a preallocated bytearray.
+
+    The storage is mirrored (every byte is written at pos and pos + capacity),
+    so any window of up to `capacity` bytes is contiguous and can be returned
+    as a memoryview without copying.
+    Writers and readers are synchronized with a single condition variable.
+    """
+
+    def __init__(self, capacity, overflow=Overflow.DROP_OLDEST):
+        self.capacity = int(capacity)
+        self.overflow = Overflow(overflow)
+        self._data = bytearray(2 * self.capacity)
+        self._view = memoryview(self._data)
+        self._start = 0
+        self._size = 0
+        self._closed = False
+        self.dropped = 0
+        self.cond = Condition()
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def _deadline(self, timeout):
+        return None if timeout is None else time.monotonic() + timeout
+
+    def _wait(self, predicate, deadline):
+        while not predicate():
+            if self._closed:
+                return False
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            self.cond.wait(remaining)
+        return True
+
+    def _put(self, data):
+        n = len(data)
+        pos = (self._start + self._size) % self.capacity
+        first = min(n, self.capacity - pos)
+        self._view[pos:pos + first] = data[:first]
+        self._view[pos + self.capacity:pos + self.capacity + first] = data[:first]
+        if first < n:
+            rest = n - first
+            self._view[:rest] = data[first:]
+            self._view[self.capacity:self.capacity + rest] = data[first:]
+        self._size += n
+
+    def write(self, s, timeout=None):
+        """
+        Appends bytes to the ring, applying the overflow policy when it is full.
+        Returns the number of bytes written
+        """
+        data = memoryview(s).cast('B')
+        if len(data) > self.capacity:
+            if self.overflow is Overflow.RAISE:
+                raise BufferError(f'Write of {len(data)} bytes exceeds capacity {self.capacity}')
+            if self.overflow is Overflow.DROP_OLDEST:
+                skipped = len(data) - self.capacity
+                self.dropped += skipped
+                data = data[skipped:]
+
+        with self.cond:
+            written = 0
+            deadline = self._deadline(timeout)
+            while written < len(data):
+                free = self.capacity - self._size
+                part = data[written:]
+                if len(part) > free:
+                    if self.overflow is Overflow.RAISE:
+                        raise BufferError(f'Ring buffer full ({self._size}/{self.capacity} bytes)')
+                    if self.overflow is Overflow.DROP_OLDEST:
+                        drop = len(part) - free
+                        self._start = (self._start + drop) % self.capacity
+                        self._size -= drop
+                        self.dropped += drop
+                    else:
+                        if free == 0 and not self._wait(lambda: self._size < self.capacity, deadline):
+                            break
+                        part = part[:self.capacity - self._size]
+                self._put(part)
+                written += len(part)
+                self.cond.notify_all()
+            return written
+
+    def _take(self, n):
+        view = self._view[self._start:self._start + n]
+        self._start = (self._start + n) % self.capacity
+        self._size -= n
+        self.cond.notify_all()
+        return view
+
+    def read_view(self, n=-1, timeout=None):
+        """
+        Returns up to n bytes as a memoryview into the ring without copying.
+        The view is only valid until the next write reuses that region, so
+        consume it before reading again. Returns an empty view on timeout,
+        or whatever is left once the buffer is closed
+        """
+        with self.cond:
+            if n == -1:
+                n = self._size
+            n = min(n, self.capacity)
+            if not self._wait(lambda: self._size >= n, self._deadline(timeout)):
+                if not self._closed:
+                    return self._view[:0]
+                n = min(n, self._size)
+            return self._take(n)
+
+    def read(self, n=-1, timeout=None):
+        """Same as read_view, but returns a copy as bytes"""
+        with self.cond:
+            return bytes(self.read_view(n, timeout))
+
+    def readinto(self, buffer, timeout=None):
+        """Fills the given buffer from the ring. Returns the number of bytes copied"""
+        out = memoryview(buffer).cast('B')
+        with self.cond:
+            view = self.read_view(len(out), timeout)
+            out[:len(view)] = view
+            return len(view)
+
+    def read_available(self, n):
+        """Non-blocking read of at most n bytes"""
+        with self.cond:
+            return bytes(self._take(min(n, self._size)))
+
+    def peek(self, n=-1):
+        """Returns a view of the newest n bytes without consuming them"""
+        with self.cond:
+            n = self._size if n == -1 else min(n, self._size)
+            end = self._start + self._size
+            return self._view[end - n:end]
+
+    def clear(self):
+        with self.cond:
+            self._start = 0
+            self._size = 0
+            self.cond.notify_all()
+
+    def close(self):
+        """Wakes up blocked readers and writers, reads return what is left"""
+        with self.cond:
+            self._closed = True
+            self.cond.notify_all()
@@ -0,0 +1,142 @@
+"""
+Local stand-in for the ZeroMQ router, for testing clients without the real one.
+
+Accepts GREET, START_SPEAK, CONTINUE, FINISH, CANCEL, CLEAR and PING from DEALER clients.
+Every finished utterance is answered with INIT_CONVERSATION followed by
+SPEAK frames of a canned 16 kHz mono int16 reply, decoded CONTINUE audio is
+only counted. CLEAR stops the reply being streamed. PING is answered with a PONG echoing its parameters.
+Clients advertising a codec in GREET are decoded with it.
+
+    python router_stub.py --bind tcp://*:5555 --reply audio.wav
+"""
+import argparse
+import asyncio
+import json
+import time
+import wave
+
+import zmq
+from zmq.asyncio import Context
+
+import logger
+from codec import get_codec, PCM16
+from commands import Command
+from tracing import Window
+
+log = logger.get(__name__)
+
+FRAME_SAMPLES = 1024
+
+
+def load_reply(path):
+    with wave.open(path, 'rb') as f:
+        return f.readframes(f.getnframes())
+
+
+class RouterStub(object):
+    def __init__(self, bind='tcp://*:5555', reply=b'', reply_delay=0.0, realtime=True):
+        self.bind = bind
+        self.reply = reply
+        self.reply_delay = reply_delay
+        self.realtime = realtime
+        self.socket = None
+        self.sessions = {}
+        self.messages = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.audio_seconds = 0.0
+        self.loop_lag = Window()
+        self.stream_id = 0
+        self.answers = {}
+
+    def _count(self, command, size):
+        self.messages[command] = self.messages.get(command, 0) + 1
+        self.bytes_in += size
+
+    async def _send(self, identity, tag, params=None, audio=b''):
+        self.bytes_out += len(audio)
+        await self.socket.send_multipart([identity, tag, json.dumps(params).encode() if params else b'', audio])
+
+    async def _answer(self, identity):
+        """Streams the canned reply back to a client at twice real time, like a streaming TTS"""
+        self.stream_id += 1
+        stream_id = self.stream_id
+        await asyncio.sleep(self.reply_delay)
+        await self._send(identity, b'INIT_CONVERSATION')
+        frame_bytes = FRAME_SAMPLES * 2
+        for offset in range(0, len(self.reply), frame_bytes):
+            await self._send(identity, b'SPEAK', {'stream_id': stream_id}, self.reply[offset:offset + frame_bytes])
+            if self.realtime:
+                await asyncio.sleep(FRAME_SAMPLES / 16000 / 2)
+
+    async def _pong(self, identity, params):
+        await self.socket.send_multipart([identity, b'PONG', params, b''])
+
+    def handle(self, identity, command, parts):
+        session = self.sessions.setdefault(identity, {'codec': get_codec(PCM16), 'samples': 0})
+        if command == b'GREET':
+            params = json.loads(parts[0]) if parts and parts[0] else {}
+            session['codec'] = get_codec(params.get('codec', PCM16))
+            log.info(f'{identity.decode()} greeted with {params}')
+        elif command == Command.START_SPEAK.value:
+            session['samples'] = 0
+        elif command == Command.CONTINUE.value:
+            for packet in parts:
+                session['samples'] += len(session['codec'].decode(packet)) // 2
+        elif command == Command.FINISH.value:
+            self.audio_seconds += session['samples'] / 16000
+            self.answers[identity] = asyncio.ensure_future(self._answer(identity))
+        elif command == Command.CANCEL.value:
+            session['samples'] = 0
+        elif command == Command.CLEAR.value:
+            answer = self.answers.pop(identity, None)
+            if answer:
+                answer.cancel()
+        elif command == Command.PING.value:
+            asyncio.ensure_future(self._pong(identity, parts[0] if parts else b''))
+
+    async def _measure_lag(self, interval=0.05):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(interval)
+            self.loop_lag.observe(time.monotonic() - start - interval)
+
+    async def run(self):
+        self.socket = Context.instance().socket(zmq.ROUTER)
+        self.socket.bind(self.bind)
+        log.info(f'Router stub listening on {self.bind}')
+        lag = asyncio.ensure_future(self._measure_lag())
+        try:
+            while True:
+                identity, command, *parts = await self.socket.recv_multipart()
+                self._count(command.decode(), sum(len(p) for p in parts))
+                self.handle(identity, command, parts)
+        finally:
+            lag.cancel()
+
+    def stats(self):
+        return {
+            'clients': len(self.sessions),
+            'messages': self.messages,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'audio_received_s': self.audio_seconds,
+            'loop_lag': self.loop_lag.summary(),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bind', default='tcp://*:5555')
+    parser.add_argument('--reply', default='audio.wav', help='16 kHz mono int16 WAV sent back as SPEAK frames')
+    parser.add_argument('--reply-delay', type=float, default=0.3, help='Seconds before answering a FINISH')
+    args = parser.parse_args()
+    router = RouterStub(args.bind, load_reply(args.reply), args.reply_delay)
+    try:
+        asyncio.run(router.run())
+    except KeyboardInterrupt:
+        log.info(json.dumps(router.stats()))
+
+
+if __name__ == '__main__':
+    main()
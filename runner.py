@@ -1,22 +1,63 @@
 import asyncio
 import atexit
+import logging
 import time
-from threading import Thread, Event, Timer
-
-import numpy as np
-import openwakeword
-from pysilero_vad import SileroVoiceActivityDetector
-from openwakeword.model import Model
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock
 
+import engine
 import logger
 from config import config
-
-openwakeword.utils.download_models()
+from endpointing import Endpointer, FINISHED, NO_SPEECH
+from frames import FramePool, FRAME_SAMPLES
+from gate import EnergyGate, OFF, VAD
+from inference import LocalInference, ProcessInference
+from ring_buffer import RingBuffer, Overflow
+from tracing import tracer, ENDPOINT
+from utterance import UtteranceBuffer
 
 MUTE_TIMEOUT = int(config.get('MUTE_TIMEOUT', 0))
+# 60 seconds of 16 kHz int16 audio
+STREAM_CAPACITY = int(config.get('STREAM_CAPACITY', 16000 * 2 * 60))
+# Audio kept from before the activation and sent right after it, so words
+# spoken while the trigger window was still open are not lost
+PRE_ROLL_MS = int(config.get('PRE_ROLL_MS', 500))
+# Oldest part of the pre-roll to drop, typically the wake word itself
+PRE_ROLL_TRIM_MS = int(config.get('PRE_ROLL_TRIM_MS', 0))
+# Run wake word and VAD inference in a separate process instead of the capture thread
+INFERENCE_PROCESS = config.get('INFERENCE_PROCESS', 'false').lower() in ('1', 'true', 'yes')
+# Skip wake word inference during silence: off, energy or vad (energy confirmed by VAD)
+WAKE_GATE = config.get('WAKE_GATE', OFF)
+WAKE_GATE_RATIO = float(config.get('WAKE_GATE_RATIO', 3.0))
+WAKE_GATE_MIN_RMS = float(config.get('WAKE_GATE_MIN_RMS', 100))
+WAKE_GATE_DECIMATION = int(config.get('WAKE_GATE_DECIMATION', 4))
+# Grow the trailing silence window with the utterance length, see endpointing.Endpointer
+ENDPOINT_ADAPTIVE = config.get('ENDPOINT_ADAPTIVE', 'false').lower() in ('1', 'true', 'yes')
+ENDPOINT_MIN_SILENCE = float(config.get('ENDPOINT_MIN_SILENCE', 0.5))
+ENDPOINT_MAX_SILENCE = float(config.get('ENDPOINT_MAX_SILENCE', 1.5))
+# While the speaker plays, sensitivity is lowered by up to this much, scaled by
+# the playback RMS relative to PLAYBACK_LEVEL_FULL, so the reply does not wake the device
+PLAYBACK_SENSITIVITY_PENALTY = float(config.get('PLAYBACK_SENSITIVITY_PENALTY', 0.2))
+PLAYBACK_LEVEL_FULL = float(config.get('PLAYBACK_LEVEL_FULL', 4000))
+# Scores above this are logged at debug level even when they do not activate
+WAKE_WORD_DEBUG_THRESHOLD = float(config.get('WAKE_WORD_DEBUG_THRESHOLD', 0.6))
 
 log = logger.get(__name__)
 
+
+def ms_to_bytes(ms, rate=16000, sample_width=2):
+    return int(rate * ms / 1000) * sample_width
+
+
+def parse_per_word(value, cast):
+    """Parses 'alexa:0.8,Mahvareek:0.6' into {'alexa': 0.8, 'Mahvareek': 0.6}"""
+    result = {}
+    for item in filter(None, (value or '').split(',')):
+        name, _, level = item.partition(':')
+        result[name.strip()] = cast(level)
+    return result
+
+
 class TriggerDetector:
     """
     Reads predictions and detects activations
@@ -24,22 +65,24 @@ class TriggerDetector:
     the predictions look like ...!!!..!!...
     """
 
-    def __init__(self, chunk_size, sensitivity=0.5, trigger_level=3):
+    def __init__(self, chunk_size, sensitivity=0.5, trigger_level=3, cooldown=8 * 2048):
         self.chunk_size = chunk_size
         self.sensitivity = sensitivity
         self.trigger_level = trigger_level
+        # Samples after an activation during which no new activation can happen
+        self.cooldown = cooldown
         self.activation = 0
 
-    def update(self, prob):
-        # type: (float) -> bool
-        """Returns whether the new prediction caused an activation"""
-        chunk_activated = prob > 1.0 - self.sensitivity
+    def update(self, prob, penalty=0.0):
+        # type: (float, float) -> bool
+        """Returns whether the new prediction caused an activation, `penalty` is subtracted from the sensitivity"""
+        chunk_activated = prob > 1.0 - self.sensitivity + penalty
 
         if chunk_activated or self.activation < 0:
             self.activation += 1
             has_activated = self.activation > self.trigger_level
             if has_activated or chunk_activated and self.activation < 0:
-                self.activation = -(8 * 2048) // self.chunk_size
+                self.activation = -self.cooldown // self.chunk_size
 
             if has_activated:
                 return True
@@ -48,40 +91,22 @@ class TriggerDetector:
         return False
 
 
-class ReadWriteStream(object):
+class ReadWriteStream(RingBuffer):
     """
     Class used to support writing binary audio data at any pace,
     optionally chopping when the buffer gets too large
+
+    Backed by a preallocated ring buffer, so writing and reading is linear
+    in the chunk size no matter how much audio is queued.
+    When chop_samples is set, the oldest audio is dropped once that many
+    bytes are queued, otherwise the overflow policy applies at capacity
     """
 
-    def __init__(self, s=b'', chop_samples=-1):
-        self.buffer = s
-        self.write_event = Event()
-        self.chop_samples = chop_samples
-
-    def __len__(self):
-        return len(self.buffer)
-
-    def read(self, n=-1, timeout=None):
-        if n == -1:
-            n = len(self.buffer)
-        if 0 < self.chop_samples < len(self.buffer):
-            samples_left = len(self.buffer) % self.chop_samples
-            self.buffer = self.buffer[-samples_left:]
-        return_time = 1e10 if timeout is None else (
-                timeout + time.time()
-        )
-        while len(self.buffer) < n:
-            self.write_event.clear()
-            if not self.write_event.wait(return_time - time.time()):
-                return b''
-        chunk = self.buffer[:n]
-        self.buffer = self.buffer[n:]
-        return chunk
-
-    def write(self, s):
-        self.buffer += s
-        self.write_event.set()
+    def __init__(self, s=b'', chop_samples=-1, capacity=STREAM_CAPACITY, overflow=Overflow.BLOCK):
+        if chop_samples > 0:
+            capacity, overflow = chop_samples, Overflow.DROP_OLDEST
+        super().__init__(max(capacity, len(s)), overflow)
+        self.write(s)
 
     def flush(self):
         """Makes compatible with sys.stdout"""
@@ -131,17 +156,29 @@ class PreciseRunner(object):
         stream (BinaryIO): Binary audio stream to read 16000 Hz 1 channel int16
                            audio from. If not given, the microphone is used
         on_prediction (Callable): callback for every new prediction
-        on_activation (Callable): callback for when the wake word is heard
+        on_activation (Callable): callback for when a wake word is heard, gets the wake word name
+        inference_process (bool): Run the models in a worker process, see inference.ProcessInference
+        wake_word (str): Comma separated names of the models in models/ to use, defaults to WAKE_WORD_MODEL.
+                         All of them share one feature front end, per word sensitivity and trigger level
+                         can be set with WAKE_WORD_SENSITIVITY and WAKE_WORD_TRIGGER_LEVEL
+        lazy_load (bool): Load the models in the background, start() waits for them
+        playback_level (Callable): Returns the current speaker output RMS, lowers the sensitivity while playing
+        echo (EchoCanceller): Removes the speaker output from the microphone before detection, see echo.py
     """
 
-    SILENCE_DELAY_THRESHOLD = 1
-    WAIT_FOR_SPEECH_DURATION = 4
+    SILENCE_DELAY_THRESHOLD = float(config.get('SILENCE_DELAY_THRESHOLD', 1))
+    WAIT_FOR_SPEECH_DURATION = float(config.get('WAIT_FOR_SPEECH_DURATION', 4))
 
     def __init__(self, trigger_level=3, sensitivity=0.5, stream=None,
                  on_prediction=lambda x: None,
                  on_finish_phrase=lambda x, y: None,
-                 on_activation=lambda: None,
-                 on_listen_phrase=lambda x: None):
+                 on_activation=lambda wake_word: None,
+                 on_listen_phrase=lambda x: None,
+                 inference_process=INFERENCE_PROCESS,
+                 wake_word=None,
+                 lazy_load=False,
+                 playback_level=lambda: 0.0,
+                 echo=None):
         self.speech_detected = False
         self.wake_word_detected = False
         self.trigger_level = trigger_level
@@ -150,53 +187,148 @@ class PreciseRunner(object):
         self.on_activation = on_activation
         self.on_listen_phrase = on_listen_phrase
         self.on_finish_phrase = on_finish_phrase
-        self.chunk_size = 1024
-        self.speech = bytearray()
-        self.wake_word = config.get('WAKE_WORD_MODEL')
-        self.wakewords = [
-            # 'models/Mahvareek.tflite',
-            # 'models/ahtlahz.onnx',
-            # 'models/ahtl_us.onnx',
-
-            f'models/{self.wake_word}.tflite',
-        ]
-        self.model = Model(self.wakewords, inference_framework='tflite')
-        self.pa = None
+        self.playback_level = playback_level
+        self.echo = echo
+        # In bytes, like the stream reads
+        self.chunk_size = FRAME_SAMPLES * 2
+        self.speech = UtteranceBuffer()
+        self.frames = FramePool(self.chunk_size // 2)
+        self.pre_roll = RingBuffer(max(ms_to_bytes(PRE_ROLL_MS), 1), Overflow.DROP_OLDEST)
+        self.pre_roll_trim = ms_to_bytes(PRE_ROLL_TRIM_MS)
+        self.wake_words = [name.strip() for name in (wake_word or config.get('WAKE_WORD_MODEL')).split(',')]
+        self.wake_word = self.wake_words[0]
+        # Set by load() once the engine is chosen, see engine.select
+        self.framework = None
+        self.threads = None
+        self.wakewords = []
+        self.inference_process = inference_process
+        self.inference = None
+        self.gate = None
+        self.loading = None
+        self.capture = None
         self.thread = None
         self.running = False
         self.is_paused = False
-
-        self.vad_model = SileroVoiceActivityDetector()
-        self.detector = TriggerDetector(self.chunk_size, sensitivity, trigger_level)
-        self.false_speech_timer = Timer(self.WAIT_FOR_SPEECH_DURATION, self.false_speech_callback)
-        self.finish_speech_timer = Timer(self.SILENCE_DELAY_THRESHOLD, lambda: print("finish speech"))
+        self.mute_deadline = None
+        self.mute_lock = Lock()
+        self.resumed = False
+        self.cancelled = False
+        self.activation_score = 0.0
+        self.activation_energy = 0.0
+        # Scores above WAKE_WORD_DEBUG_THRESHOLD are logged at most once a second per word
+        self.score_throttle = logger.Throttle(1.0)
+
+        sensitivities = parse_per_word(config.get('WAKE_WORD_SENSITIVITY'), float)
+        trigger_levels = parse_per_word(config.get('WAKE_WORD_TRIGGER_LEVEL'), int)
+        cooldowns = parse_per_word(config.get('WAKE_WORD_COOLDOWN'), int)
+        self.detectors = {
+            name: TriggerDetector(self.chunk_size,
+                                  sensitivities.get(name, sensitivity),
+                                  trigger_levels.get(name, trigger_level),
+                                  cooldowns.get(name, 8 * 2048))
+            for name in self.wake_words
+        }
+        self.endpointer = Endpointer(silence_delay=self.SILENCE_DELAY_THRESHOLD,
+                                     wait_for_speech=self.WAIT_FOR_SPEECH_DURATION,
+                                     adaptive=ENDPOINT_ADAPTIVE,
+                                     min_silence=ENDPOINT_MIN_SILENCE,
+                                     max_silence=ENDPOINT_MAX_SILENCE)
+        if lazy_load:
+            executor = ThreadPoolExecutor(1, thread_name_prefix='model-loader')
+            self.loading = executor.submit(self.load)
+            executor.shutdown(wait=False)
+        else:
+            self.load()
         atexit.register(self.stop)
 
+    def load(self):
+        """Loads and warms up the wake word and VAD models"""
+        start = time.perf_counter()
+        self.framework, self.threads = engine.select(self.wake_words)
+        self.wakewords = engine.model_paths(self.wake_words, self.framework)
+        if self.inference_process:
+            self.inference = ProcessInference(self.wakewords, self.framework, FRAME_SAMPLES, threads=self.threads)
+        else:
+            self.inference = LocalInference(self.wakewords, self.framework, FRAME_SAMPLES, self.threads)
+        if WAKE_GATE != OFF:
+            self.gate = EnergyGate(WAKE_GATE_RATIO, WAKE_GATE_MIN_RMS, decimation=WAKE_GATE_DECIMATION,
+                                   vad=self.inference.vad if WAKE_GATE == VAD else None)
+        timings = {**self.inference.timings, 'total': time.perf_counter() - start}
+        log.info(f'Models loaded with {self.framework} on {self.threads} threads in ' +
+                 ', '.join(f'{k} {v * 1000:.0f} ms' for k, v in timings.items()))
+        return timings
+
     def wake_up(self, timeout=WAIT_FOR_SPEECH_DURATION):
         self.wake_word_detected = True
-        self.false_speech_timer = Timer(timeout, self.false_speech_callback)
-        self.false_speech_timer.start()
+        self.endpointer.start(timeout)
 
     def mute(self, timeout=MUTE_TIMEOUT):
+        """
+        Stops processing mic input until un_mute() or until `timeout` seconds pass.
+        Repeated mutes extend the deadline instead of stacking timers,
+        a timeout of 0 mutes until un_mute()
+        """
         log.info(f'Mute mic for {timeout} seconds')
-        self.is_paused = True
-        if timeout > 0:
-            Timer(timeout, self.un_mute).start()
+        deadline = time.monotonic() + timeout if timeout > 0 else None
+        with self.mute_lock:
+            if not self.is_paused or deadline is None:
+                self.mute_deadline = deadline
+            elif self.mute_deadline is not None:
+                self.mute_deadline = max(self.mute_deadline, deadline)
+            self.is_paused = True
 
     def un_mute(self):
         log.info('Unmute mic')
-        self.is_paused = False
+        with self.mute_lock:
+            self.is_paused = False
+            self.mute_deadline = None
+            self.resumed = True
+
+    def cancel(self):
+        """Stops listening without calling on_finish_phrase"""
+        self.cancelled = True
+
+    def _mute_expired(self):
+        with self.mute_lock:
+            return self.mute_deadline is not None and time.monotonic() >= self.mute_deadline
+
+    def _clear_wake_state(self):
+        """Forgets the audio heard so far, so it can not trigger a late activation"""
+        self.pre_roll.clear()
+        for detector in self.detectors.values():
+            detector.activation = 0
+        self.inference.reset()
+        if self.gate:
+            self.gate.reset()
+
+    def reset(self):
+        """Drops any listening state and buffered audio"""
+        self.endpointer.stop()
+        self.wake_word_detected = False
+        self.speech_detected = False
+        self.speech.clear()
+        self._clear_wake_state()
 
     def false_speech_callback(self):
         self.on_finish_phrase(self.speech_detected, None)
         self.wake_word_detected = False
         self.speech.clear()
+        self.pre_roll.clear()
 
-    def finish_speech_callback(self):
-        self.on_finish_phrase(self.speech_detected, self.speech)
+    def finish_speech_callback(self, captured=None):
+        tracer.mark(ENDPOINT, captured)
+        self.on_finish_phrase(self.speech_detected, self.speech.view())
         self.wake_word_detected = False
         self.speech_detected = False
         self.speech.clear()
+        self.pre_roll.clear()
+
+    def _flush_pre_roll(self):
+        """Sends the buffered audio preceding the activation as one chunk"""
+        data = self.pre_roll.read_available(len(self.pre_roll))[self.pre_roll_trim:]
+        if data:
+            self.on_listen_phrase(data)
+            self.speech.extend(data)
 
     def _wrap_stream_read(self, stream):
         """
@@ -209,20 +341,13 @@ class PreciseRunner(object):
 
     async def start(self):
         """Start listening from stream"""
+        if self.loading:
+            await asyncio.wrap_future(self.loading)
         if self.stream is None:
-            from pyaudio import PyAudio, paInt16
-            self.pa = PyAudio()
-            self.stream = self.pa.open(
-                16000,
-                1,
-                paInt16,
-                True,
-                False,
-                int(config.get('SOUND_DEVICE_INDEX', 0)),
-                frames_per_buffer=self.chunk_size
-            )
-
-        self._wrap_stream_read(self.stream)
+            from capture import Capture
+            self.stream = self.capture = Capture()
+        else:
+            self._wrap_stream_read(self.stream)
 
         self.running = True
         self.is_paused = False
@@ -234,47 +359,111 @@ class PreciseRunner(object):
         """Stop listening and close stream"""
         if self.thread:
             self.running = False
-            if isinstance(self.stream, ReadWriteStream):
-                self.stream.write(b'\0' * self.chunk_size)
+            if self.capture or isinstance(self.stream, ReadWriteStream):
+                self.stream.close()
             self.thread.join()
             self.thread = None
 
-        if self.pa:
-            self.pa.terminate()
-            self.stream.stop_stream()
-            self.stream = self.pa = None
+        if self.inference:
+            self.inference.close()
 
-    def _wake_word_detected(self, frame):
-        prediction = self.model.predict(frame)
+        if self.capture:
+            self.stream = self.capture = None
 
-        if prediction[self.wake_word] >= 0.6:
-            print(f'Activation without update: {prediction}')
-        activated = self.detector.update(prediction[self.wake_word])
-        if activated:
-            print(f'Activation with update: {prediction}')
-        return activated and not self.wake_word_detected
+    def _wake_word_detected(self, frame):
+        """Returns the name of the wake word that activated, if any"""
+        activated = None
+        samples = frame.int16
+        penalty = PLAYBACK_SENSITIVITY_PENALTY * min(self.playback_level() / PLAYBACK_LEVEL_FULL, 1.0)
+        for gated_frame in self.gate.update(samples, frame.rms) if self.gate else (samples,):
+            start = time.perf_counter()
+            prediction = self.inference.predict(gated_frame)
+            tracer.observe('wake_inference', time.perf_counter() - start)
+
+            for name, detector in self.detectors.items():
+                score = prediction[name]
+                if score >= WAKE_WORD_DEBUG_THRESHOLD and log.isEnabledFor(logging.DEBUG):
+                    skipped = self.score_throttle(name)
+                    if skipped is not None:
+                        log.debug('Wake word score', extra=logger.fields(word=name, score=round(float(score), 3),
+                                                                         skipped=skipped))
+                if detector.update(score, penalty):
+                    log.info('Wake word activation', extra=logger.fields(word=name, score=round(float(score), 3)))
+                    if not activated:
+                        activated = name
+                        self.activation_score = prediction[name]
+                        self.activation_energy = frame.rms if gated_frame is samples else EnergyGate.rms(gated_frame)
+        return None if self.wake_word_detected else activated
+
+    def _read_frame(self):
+        """Fills a pooled frame with the next chunk and the time its last sample was captured"""
+        frame = self.frames.acquire()
+        if self.capture:
+            n, captured = self.capture.readinto_frame(frame.buffer)
+            tracer.observe('capture_to_process', time.monotonic() - captured)
+            return frame.filled(n, captured)
+        return frame.fill(self.stream.read(self.chunk_size), time.monotonic())
 
     def _handle_predictions(self):
         """Continuously check Precise process output"""
         while self.running:
-            if self.is_paused:
-                continue
-
-            chunk = self.stream.read(self.chunk_size)
-            frame = np.frombuffer(chunk, dtype=np.int16)
-            if self._wake_word_detected(frame):
-                self.wake_up()
-                self.on_activation()
-
-            if self.wake_word_detected:
-                self.on_listen_phrase(chunk)
-                self.speech.extend(chunk)
-                voice_probability = self.vad_model(chunk)
-
-                if voice_probability > 0.5:
-                    self.false_speech_timer.cancel()
-                    self.finish_speech_timer.cancel()
-                    self.speech_detected = True
-                elif voice_probability < 0.4 and self.speech_detected and not self.finish_speech_timer.is_alive():
-                    self.finish_speech_timer = Timer(self.SILENCE_DELAY_THRESHOLD, self.finish_speech_callback)
-                    self.finish_speech_timer.start()
+            # Keep reading while muted, so the capture ring does not overflow
+            # and no stale audio is processed after unmuting
+            frame = self._read_frame()
+            try:
+                if not len(frame):
+                    break
+                # A short read only happens at the end of a closed stream, the models take whole frames
+                if len(frame) < self.chunk_size:
+                    continue
+                self._process_frame(frame)
+            finally:
+                frame.release()
+
+    def _process_frame(self, frame):
+        if self.is_paused:
+            if not self._mute_expired():
+                return
+            self.un_mute()
+        if self.resumed:
+            self.resumed = False
+            self._clear_wake_state()
+        if self.cancelled:
+            self.cancelled = False
+            self.endpointer.stop()
+            self.wake_word_detected = False
+            self.speech_detected = False
+            self.speech.clear()
+        if self.echo:
+            start = time.perf_counter()
+            self.echo.process(frame)
+            tracer.observe('echo_cancel', time.perf_counter() - start)
+        wake_word = self._wake_word_detected(frame)
+        if wake_word:
+            tracer.start(frame.captured)
+            self.wake_up()
+            self.on_activation(wake_word)
+            self._flush_pre_roll()
+
+        # Consumers get a view into the pooled frame and have to copy what they keep
+        chunk = frame.data
+        if self.wake_word_detected:
+            self.on_listen_phrase(chunk)
+            self.speech.extend(chunk)
+            start = time.perf_counter()
+            # float32 is converted once per frame and shared with the RMS
+            voice_probability = self.inference.vad(frame.float32)
+            tracer.observe('vad_inference', time.perf_counter() - start)
+            event = self.endpointer.update(voice_probability, len(chunk) // 2)
+            self.speech_detected = self.speech_detected or self.endpointer.speech_detected
+
+            if event == NO_SPEECH:
+                self.false_speech_callback()
+            elif event == FINISHED:
+                self.finish_speech_callback(frame.captured)
+            elif self.speech.full:
+                log.warning(f'Utterance reached {len(self.speech) // 32} ms, finishing')
+                self.endpointer.stop()
+                self.finish_speech_callback(frame.captured)
+        elif PRE_ROLL_MS > 0:
+            self.pre_roll.write(chunk)
@@ -0,0 +1,236 @@
+"""
+Router session on top of Client: a bounded send queue, reconnect handling and link metrics.
+
+Commands are queued instead of sent directly and a single sender task drains
+the queue while the router is connected. Messages the socket can not take
+right away, because the router is gone or past the high-water mark, go back
+to the front of the queue, so they wait here, where the drop policy applies:
+START_SPEAK, FINISH and CANCEL are never dropped and the oldest CONTINUE
+audio is dropped once SESSION_QUEUE_CHUNKS packets are waiting. A CANCEL
+discards the CONTINUE audio of its own utterance still queued before it.
+With SESSION_MERGE_PACKETS set, queued CONTINUE messages are merged into
+larger multipart messages and GREET carries the limit as `merge`, so the
+router knows a CONTINUE may hold more packets than the uplink `batch`.
+A socket monitor re-sends GREET on every new connection, and START_SPEAK
+when an utterance was in progress. With SESSION_PING_INTERVAL set, PING
+messages are stamped as they leave the queue and measure the round trip
+time when the router answers with PONG.
+"""
+import asyncio
+import json
+import time
+from collections import deque
+
+import zmq
+from zmq.utils.monitor import parse_monitor_message
+
+import logger
+from commands import Command
+from config import config
+from tracing import tracer, Window
+
+log = logger.get(__name__)
+
+# CONTINUE packets kept while the router can not take them, about 2 s of audio
+SESSION_QUEUE_CHUNKS = int(config.get('SESSION_QUEUE_CHUNKS', 64))
+# Most packets merged into one CONTINUE message when the queue backs up, 0 keeps
+# every message as the uplink batched it. Off by default: merged messages do
+# not match the `batch` announced in GREET, only routers reading `merge` take them
+SESSION_MERGE_PACKETS = int(config.get('SESSION_MERGE_PACKETS', 0))
+# Seconds between PINGs, 0 disables them. Off by default: only routers that
+# answer PING with PONG (like router_stub.py) can use it, liveness is
+# already covered by the ZMTP heartbeats set on the socket
+SESSION_PING_INTERVAL = float(config.get('SESSION_PING_INTERVAL', 0))
+# Wait before retrying a message the socket did not accept
+SESSION_RETRY_DELAY = 0.01
+
+GREET = b'GREET'
+PONG = 'PONG'
+_HANDSHAKE = getattr(zmq, 'EVENT_HANDSHAKE_SUCCEEDED', zmq.EVENT_CONNECTED)
+
+
+class SendQueue(object):
+    """FIFO of (command, parts, queued_at) applying the per command drop policy"""
+
+    def __init__(self, max_chunks=SESSION_QUEUE_CHUNKS, merge=SESSION_MERGE_PACKETS):
+        self.items = deque()
+        self.max_chunks = max_chunks
+        self.merge = merge
+        self.chunks = 0
+        self.dropped = 0
+        self.merged = 0
+        self.ready = asyncio.Event()
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, command, parts, front=False, queued_at=None):
+        now = time.monotonic() if queued_at is None else queued_at
+        if front:
+            self.items.appendleft((command, list(parts), now))
+            if command == Command.CONTINUE.value:
+                self.chunks += len(parts)
+        elif command == Command.CONTINUE.value:
+            self._put_continue(parts, now)
+        else:
+            if command == Command.CANCEL.value:
+                self._discard_continue()
+            self.items.append((command, list(parts), now))
+        self.ready.set()
+
+    def _put_continue(self, parts, now):
+        tail = self.items[-1] if self.items else None
+        if tail and self.merge and tail[0] == Command.CONTINUE.value and len(tail[1]) + len(parts) <= self.merge:
+            tail[1].extend(parts)
+            self.merged += 1
+        else:
+            self.items.append((Command.CONTINUE.value, list(parts), now))
+        self.chunks += len(parts)
+        while self.chunks > self.max_chunks:
+            self._drop_oldest_packet()
+
+    def _drop_oldest_packet(self):
+        for item in self.items:
+            if item[0] == Command.CONTINUE.value:
+                item[1].pop(0)
+                self.chunks -= 1
+                self.dropped += 1
+                if not item[1]:
+                    self.items.remove(item)
+                return
+
+    def _discard_continue(self):
+        """Drops the CONTINUE audio of the utterance being cancelled, what came before its start stays"""
+        boundaries = (Command.START_SPEAK.value, Command.FINISH.value, Command.CANCEL.value)
+        start = max((i + 1 for i, item in enumerate(self.items) if item[0] in boundaries), default=0)
+        kept = deque()
+        for i, item in enumerate(self.items):
+            if i >= start and item[0] == Command.CONTINUE.value:
+                self.chunks -= len(item[1])
+                self.dropped += len(item[1])
+            else:
+                kept.append(item)
+        self.items = kept
+
+    async def get(self):
+        while not self.items:
+            self.ready.clear()
+            await self.ready.wait()
+        command, parts, queued_at = self.items.popleft()
+        if command == Command.CONTINUE.value:
+            self.chunks -= len(parts)
+        return command, parts, queued_at
+
+
+class Session(object):
+    def __init__(self, client, ping_interval=SESSION_PING_INTERVAL):
+        self.client = client
+        self.ping_interval = ping_interval
+        self.queue = SendQueue()
+        if self.queue.merge:
+            client.greeting = {**(client.greeting or {}), 'merge': self.queue.merge}
+        self.link = asyncio.Event()
+        self.connected = False
+        self.connections = 0
+        self.speaking = None
+        self.rtt = Window()
+
+    async def send(self, command, *parts):
+        """Queues a command for the router, never blocks"""
+        if command == Command.START_SPEAK.value:
+            self.speaking = parts
+        elif command in (Command.FINISH.value, Command.CANCEL.value):
+            self.speaking = None
+        self.queue.put(command, parts)
+        tracer.gauge('send_queue_depth', len(self.queue))
+
+    def _on_connected(self):
+        self.connected = True
+        self.connections += 1
+        if self.connections > 1:
+            log.info(f'Reconnected to router, {len(self.queue)} messages queued, {self.queue.dropped} packets dropped')
+        # Front of the queue in reverse order: GREET, then the interrupted utterance
+        if self.connections > 1 and self.speaking is not None and \
+                not any(item[0] == Command.START_SPEAK.value for item in self.queue.items):
+            self.queue.put(Command.START_SPEAK.value, self.speaking, front=True)
+        self.queue.put(GREET, [json.dumps(self.client.greeting).encode() if self.client.greeting else b''],
+                       front=True)
+        self.link.set()
+        tracer.gauge('router_connected', 1)
+        tracer.gauge('router_connections', self.connections)
+
+    def _on_disconnected(self):
+        if self.connected:
+            log.warning('Lost the router connection')
+        self.connected = False
+        self.link.clear()
+        tracer.gauge('router_connected', 0)
+
+    async def _monitor(self):
+        monitor = self.client.socket.get_monitor_socket(_HANDSHAKE | zmq.EVENT_DISCONNECTED)
+        try:
+            while True:
+                event = parse_monitor_message(await monitor.recv_multipart())
+                if event['event'] == _HANDSHAKE:
+                    self._on_connected()
+                elif event['event'] == zmq.EVENT_DISCONNECTED:
+                    self._on_disconnected()
+        finally:
+            self.client.socket.disable_monitor()
+
+    async def _sender(self):
+        while True:
+            await self.link.wait()
+            command, parts, queued_at = await self.queue.get()
+            payload = parts
+            if command == Command.PING.value:
+                # Stamped when it leaves the queue, so the RTT is the network and router time
+                payload = [json.dumps({'ts': time.monotonic()}).encode()]
+            try:
+                await self.client.send(command, *payload, flags=zmq.NOBLOCK)
+            except zmq.Again:
+                self.queue.put(command, parts, front=True, queued_at=queued_at)
+                await asyncio.sleep(SESSION_RETRY_DELAY)
+                continue
+            tracer.observe('send_queue_wait', time.monotonic() - queued_at)
+            tracer.gauge('send_queue_depth', len(self.queue))
+            tracer.gauge('send_queue_dropped', self.queue.dropped)
+
+    async def _pinger(self):
+        if not self.ping_interval:
+            return
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            if self.connected:
+                await self.send(Command.PING.value, b'')
+
+    def _receiver(self, callback):
+        def on_receive(tag, params, audio):
+            if tag == PONG:
+                if params and 'ts' in params:
+                    rtt = time.monotonic() - params['ts']
+                    self.rtt.observe(rtt)
+                    tracer.observe('router_rtt', rtt)
+                return
+            callback(tag, params, audio)
+        return on_receive
+
+    def stats(self):
+        return {
+            'connected': self.connected,
+            'connections': self.connections,
+            'queued': len(self.queue),
+            'queued_chunks': self.queue.chunks,
+            'dropped_chunks': self.queue.dropped,
+            'merged_messages': self.queue.merged,
+            'rtt': self.rtt.summary(),
+        }
+
+    async def start(self, router_listener_callback, peer_listener_callback):
+        await asyncio.gather(
+            self._monitor(),
+            self._sender(),
+            self._pinger(),
+            self.client.router_listen(self._receiver(router_listener_callback), greet=False),
+            self.client.peer_listener(peer_listener_callback),
+        )
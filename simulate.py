@@ -0,0 +1,191 @@
+"""
+Load simulator: many virtual devices talking to one router from a single process.
+
+Each device replays a WAV file through the real Client and Uplink, paced
+in real time (or faster with --speed), and ends utterances with the same
+Endpointer the runner uses, fed by an energy based stand-in for the VAD.
+Without --router a RouterStub is started in-process.
+Reports message rates, throughput, send lag (how late frames leave compared
+to their real time schedule) and FINISH to first SPEAK latency as JSON.
+
+    python simulate.py --clients 200 --utterances 3 --codec mulaw --batch 4
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import numpy as np
+import zmq
+from zmq.asyncio import Context
+
+import logger
+from client import Client
+from codec import Uplink
+from commands import Command
+from endpointing import Endpointer, FINISHED
+from frames import FRAME_SAMPLES
+from gate import EnergyGate
+from router_stub import RouterStub, load_reply
+from tracing import Window
+
+log = logger.get(__name__)
+
+RATE = 16000
+VAD_RMS = 300.0
+
+
+class VirtualDevice(object):
+    def __init__(self, index, url, audio, codec, batch, speed, stats):
+        self.uplink = Uplink(codec, batch)
+        self.client = Client(url, f'sim-{index}', self.uplink.greeting(), peers_port=0)
+        self.endpointer = Endpointer()
+        self.audio = audio
+        self.speed = speed
+        self.stats = stats
+        self.finish_sent = None
+        self.replied = asyncio.Event()
+
+    def on_receive(self, tag, params, frame):
+        self.stats['received'] += 1
+        self.stats['bytes_received'] += len(frame)
+        if tag == 'SPEAK' and self.finish_sent is not None:
+            self.stats['finish_to_first_speak'].observe(time.monotonic() - self.finish_sent)
+            self.finish_sent = None
+            self.replied.set()
+
+    async def send(self, command, *parts):
+        await self.client.send(command, *parts)
+        self.stats['sent'] += 1
+        self.stats['bytes_sent'] += sum(len(p) for p in parts)
+
+    def chunks(self):
+        """The recording followed by silence, so the endpointer can finish"""
+        for offset in range(0, len(self.audio) - FRAME_SAMPLES + 1, FRAME_SAMPLES):
+            yield self.audio[offset:offset + FRAME_SAMPLES]
+        silence = np.zeros(FRAME_SAMPLES, dtype=np.int16)
+        while True:
+            yield silence
+
+    async def utterance(self, reply_timeout):
+        await self.send(Command.START_SPEAK.value, b'')
+        self.endpointer.start()
+        chunk_duration = FRAME_SAMPLES / RATE / self.speed
+        start = time.monotonic()
+        event = None
+        for index, chunk in enumerate(self.chunks()):
+            scheduled = start + index * chunk_duration
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.stats['send_lag'].observe(max(time.monotonic() - scheduled, 0))
+
+            probability = 1.0 if EnergyGate.rms(chunk) > VAD_RMS else 0.0
+            event = self.endpointer.update(probability, FRAME_SAMPLES)
+            packets = self.uplink.push(chunk.tobytes())
+            if packets:
+                await self.send(Command.CONTINUE.value, *packets)
+            if event:
+                break
+
+        if event != FINISHED:
+            self.uplink.reset()
+            await self.send(Command.CANCEL.value, b'')
+            return
+        packets = self.uplink.flush()
+        if packets:
+            await self.send(Command.CONTINUE.value, *packets)
+        self.replied.clear()
+        await self.send(Command.FINISH.value, b'')
+        self.finish_sent = time.monotonic()
+        try:
+            await asyncio.wait_for(self.replied.wait(), reply_timeout)
+            self.stats['completed'] += 1
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+
+    async def run(self, utterances, start_delay, reply_timeout):
+        listener = asyncio.ensure_future(self.client.router_listen(self.on_receive))
+        await asyncio.sleep(start_delay)
+        try:
+            for _ in range(utterances):
+                await self.utterance(reply_timeout)
+                await asyncio.sleep(random.uniform(0.5, 2.0) / self.speed)
+        finally:
+            listener.cancel()
+
+
+async def simulate(args):
+    audio = np.frombuffer(load_reply(args.wav), dtype=np.int16)
+    Context.instance().set(zmq.MAX_SOCKETS, 4 * args.clients + 64)
+
+    router = None
+    router_task = None
+    url = args.router
+    if not url:
+        router = RouterStub(f'tcp://127.0.0.1:{args.port}', load_reply(args.reply), args.reply_delay)
+        router_task = asyncio.ensure_future(router.run())
+        url = f'127.0.0.1:{args.port}'
+        await asyncio.sleep(0.1)
+
+    stats = {
+        'sent': 0, 'received': 0, 'bytes_sent': 0, 'bytes_received': 0, 'completed': 0, 'timeouts': 0,
+        'send_lag': Window(100000), 'finish_to_first_speak': Window(100000),
+    }
+    devices = [
+        VirtualDevice(i, url, audio, args.codec, args.batch, args.speed, stats)
+        for i in range(args.clients)
+    ]
+    start = time.monotonic()
+    await asyncio.gather(*(
+        device.run(args.utterances, random.uniform(0, args.ramp), args.reply_timeout) for device in devices
+    ))
+    elapsed = time.monotonic() - start
+    if router_task:
+        router_task.cancel()
+
+    return {
+        'clients': args.clients,
+        'codec': devices[0].uplink.codec.name if devices else args.codec,
+        'batch': args.batch,
+        'elapsed_s': elapsed,
+        'utterances_completed': stats['completed'],
+        'reply_timeouts': stats['timeouts'],
+        'messages_sent_per_s': stats['sent'] / elapsed,
+        'messages_received_per_s': stats['received'] / elapsed,
+        'uplink_kbit_per_s': stats['bytes_sent'] * 8 / 1000 / elapsed,
+        'downlink_kbit_per_s': stats['bytes_received'] * 8 / 1000 / elapsed,
+        'send_lag': stats['send_lag'].summary(),
+        'finish_to_first_speak': stats['finish_to_first_speak'].summary(),
+        'router': router.stats() if router else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--utterances', type=int, default=3, help='Utterances per client')
+    parser.add_argument('--wav', default='audio.wav', help='16 kHz mono int16 WAV each client speaks')
+    parser.add_argument('--codec', default='pcm16')
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay speed, 1 is real time')
+    parser.add_argument('--ramp', type=float, default=5.0, help='Seconds over which clients start')
+    parser.add_argument('--router', help='host:port of a running router, otherwise a RouterStub is started')
+    parser.add_argument('--port', type=int, default=5599, help='Port for the in-process RouterStub')
+    parser.add_argument('--reply', default='audio.wav', help='WAV the in-process RouterStub answers with')
+    parser.add_argument('--reply-delay', type=float, default=0.3)
+    parser.add_argument('--reply-timeout', type=float, default=10.0)
+    parser.add_argument('--out', help='Write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    output = json.dumps(asyncio.run(simulate(args)), indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Per-interaction latency tracing from the wake word to the first played sample.
+
+Events are stamped with time.monotonic() when they first happen in an
+interaction, spans between them go into rolling windows that can be dumped
+as JSON or scraped in Prometheus text format over HTTP (TRACE_HTTP_PORT).
+"""
+import asyncio
+import json
+import time
+from collections import deque
+from threading import Lock
+
+import numpy as np
+
+import logger
+from config import config
+
+log = logger.get(__name__)
+
+TRACE_HTTP_PORT = int(config.get('TRACE_HTTP_PORT', 0))
+TRACE_WINDOW = int(config.get('TRACE_WINDOW', 512))
+
+WAKE = 'wake'
+FIRST_CONTINUE = 'first_continue'
+ENDPOINT = 'endpoint'
+FINISH_SENT = 'finish_sent'
+FIRST_SPEAK = 'first_speak'
+FIRST_PLAYED = 'first_played'
+
+SPANS = (
+    ('wake_to_first_continue', WAKE, FIRST_CONTINUE),
+    ('endpoint_to_finish_sent', ENDPOINT, FINISH_SENT),
+    ('finish_to_first_speak', FINISH_SENT, FIRST_SPEAK),
+    ('first_speak_to_played', FIRST_SPEAK, FIRST_PLAYED),
+    ('endpoint_to_played', ENDPOINT, FIRST_PLAYED),
+    ('wake_to_played', WAKE, FIRST_PLAYED),
+)
+
+PERCENTILES = (50, 90, 99)
+
+
+class Window(object):
+    """Keeps the last `size` observations of a metric, in seconds"""
+
+    def __init__(self, size=TRACE_WINDOW):
+        self.values = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.values.append(value)
+        self.count += 1
+        self.total += value
+
+    def summary(self):
+        result = {'count': self.count, 'sum_s': self.total}
+        if self.values:
+            values = np.fromiter(self.values, dtype=np.float64) * 1000
+            result.update({f'p{p}_ms': float(np.percentile(values, p)) for p in PERCENTILES})
+            result['max_ms'] = float(values.max())
+        return result
+
+
+class Tracer(object):
+    def __init__(self, window=TRACE_WINDOW):
+        self.window = window
+        self.lock = Lock()
+        self.events = {}
+        self.windows = {}
+        self.gauges = {}
+        self.interactions = 0
+
+    def observe(self, name, seconds):
+        """Records a duration that is not tied to an interaction, e.g. per chunk inference"""
+        with self.lock:
+            if name not in self.windows:
+                self.windows[name] = Window(self.window)
+            self.windows[name].observe(seconds)
+
+    def gauge(self, name, value):
+        """Records the current value of a metric that is not a duration, e.g. a queue depth"""
+        with self.lock:
+            self.gauges[name] = value
+
+    def start(self, timestamp=None):
+        """Starts a new interaction at the wake word detection"""
+        with self.lock:
+            self.events = {WAKE: time.monotonic() if timestamp is None else timestamp}
+            self.interactions += 1
+
+    def mark(self, event, timestamp=None):
+        """Stamps the first occurrence of an event in the current interaction"""
+        if not self.events or event in self.events:
+            return
+        now = time.monotonic() if timestamp is None else timestamp
+        with self.lock:
+            if not self.events or event in self.events:
+                return
+            self.events[event] = now
+            for name, start, end in SPANS:
+                if end == event and start in self.events:
+                    if name not in self.windows:
+                        self.windows[name] = Window(self.window)
+                    self.windows[name].observe(now - self.events[start])
+
+    def dump(self):
+        with self.lock:
+            return {
+                'interactions': self.interactions,
+                'metrics': {name: window.summary() for name, window in self.windows.items()},
+                'gauges': dict(self.gauges),
+            }
+
+    def prometheus(self):
+        lines = []
+        dump = self.dump()
+        for name, value in dump['gauges'].items():
+            lines.append(f'# TYPE voice_client_{name} gauge')
+            lines.append(f'voice_client_{name} {value}')
+        for name, summary in dump['metrics'].items():
+            metric = f'voice_client_{name}_seconds'
+            lines.append(f'# TYPE {metric} summary')
+            for p in PERCENTILES:
+                if f'p{p}_ms' in summary:
+                    lines.append(f'{metric}{{quantile="{p / 100}"}} {summary[f"p{p}_ms"] / 1000}')
+            lines.append(f'{metric}_sum {summary["sum_s"]}')
+            lines.append(f'{metric}_count {summary["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            path = request.split()[1].decode() if len(request.split()) > 1 else '/'
+            if path.startswith('/metrics'):
+                body, content_type = self.prometheus(), 'text/plain; version=0.0.4'
+            else:
+                body, content_type = json.dumps(self.dump(), indent=2), 'application/json'
+            body = body.encode()
+            writer.write(f'HTTP/1.0 200 OK\r\nContent-Type: {content_type}\r\n'
+                         f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, port=TRACE_HTTP_PORT):
+        """Serves JSON on / and Prometheus text on /metrics, does nothing when port is 0"""
+        if not port:
+            return
+        server = await asyncio.start_server(self._handle, '0.0.0.0', port)
+        log.info(f'Serving latency traces on port {port}')
+        async with server:
+            await server.serve_forever()
+
+
+tracer = Tracer()
@@ -0,0 +1,153 @@
+"""
+Finds TriggerDetector settings per wake word model from a labelled corpus.
+
+Every file is scored once per model and the per-chunk scores are cached as
+.npy files, so later sweeps only replay TriggerDetector over the cached
+scores. The replay is vectorized over all sensitivity x trigger level x
+cooldown combinations at once.
+Uses the same corpus layout as benchmark.py (positive/ and negative/).
+
+    python tune.py corpus/ --models Mahvareek,ahtlahz --max-fa-per-hour 0.5
+"""
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import logger
+from benchmark import find_wavs, label_of, read_wav, list_models, POSITIVE, NEGATIVE, RATE
+from frames import FRAME_SAMPLES
+
+log = logger.get(__name__)
+
+SENSITIVITIES = np.round(np.arange(0.05, 1.0, 0.05), 2)
+TRIGGER_LEVELS = np.arange(0, 6)
+COOLDOWNS = np.array([4096, 8192, 16384, 32768])
+
+
+def score_file(inference, name, data):
+    inference.reset()
+    samples = np.frombuffer(data, dtype=np.int16)
+    return np.array([
+        inference.predict(samples[i:i + FRAME_SAMPLES])[name]
+        for i in range(0, len(samples) - FRAME_SAMPLES + 1, FRAME_SAMPLES)
+    ], dtype=np.float32)
+
+
+def cached_scores(name, files, cache_dir):
+    """Returns memory-mapped per-chunk scores for every file, computing the missing ones"""
+    from inference import LocalInference
+    import model_store
+
+    model_path = os.path.join(model_store.MODELS_DIR, f'{name}.tflite')
+    model_hash = model_store.sha256(model_path)[:16]
+    os.makedirs(os.path.join(cache_dir, name), exist_ok=True)
+    inference = None
+    scores = []
+    for path, label, data in files:
+        key = hashlib.sha1(data).hexdigest()[:16]
+        cache_path = os.path.join(cache_dir, name, f'{model_hash}-{FRAME_SAMPLES}-{key}.npy')
+        if not os.path.exists(cache_path):
+            if inference is None:
+                inference = LocalInference([model_path], 'tflite', FRAME_SAMPLES)
+            np.save(cache_path, score_file(inference, name, data))
+        scores.append(np.load(cache_path, mmap_mode='r'))
+    if inference is not None:
+        inference.close()
+    return scores
+
+
+def replay(scores, sensitivity, trigger_level, cooldown):
+    """
+    Vectorized TriggerDetector.update over parameter arrays of the same shape.
+    Returns the number of activations for each combination
+    """
+    activation = np.zeros(sensitivity.shape, dtype=np.int32)
+    activations = np.zeros(sensitivity.shape, dtype=np.int32)
+    threshold = 1.0 - sensitivity
+    # TriggerDetector counts the cooldown against the runner's chunk size in bytes
+    reset = -cooldown // (FRAME_SAMPLES * 2)
+    for prob in scores:
+        chunk_activated = prob > threshold
+        rising = chunk_activated | (activation < 0)
+        incremented = activation + 1
+        has_activated = rising & (incremented > trigger_level)
+        restart = rising & (has_activated | (chunk_activated & (incremented < 0)))
+        activation = np.where(rising, np.where(restart, reset, incremented),
+                              np.where(activation > 0, activation - 1, activation))
+        activations += has_activated
+    return activations
+
+
+def sweep(scores, labels, durations):
+    sensitivity, trigger_level, cooldown = np.meshgrid(SENSITIVITIES, TRIGGER_LEVELS, COOLDOWNS, indexing='ij')
+    sensitivity, trigger_level, cooldown = sensitivity.ravel(), trigger_level.ravel(), cooldown.ravel()
+
+    detected = np.zeros(sensitivity.shape)
+    false_accepts = np.zeros(sensitivity.shape)
+    positives = negative_seconds = 0
+    for file_scores, label, duration in zip(scores, labels, durations):
+        if label not in (POSITIVE, NEGATIVE):
+            continue
+        activations = replay(file_scores, sensitivity, trigger_level, cooldown)
+        if label == POSITIVE:
+            positives += 1
+            detected += activations > 0
+        else:
+            negative_seconds += duration
+            false_accepts += activations
+
+    recall = detected / positives if positives else np.full(sensitivity.shape, np.nan)
+    fa_per_hour = false_accepts / (negative_seconds / 3600) if negative_seconds else np.full(sensitivity.shape, np.nan)
+    return [
+        {
+            'sensitivity': float(s), 'trigger_level': int(t), 'cooldown': int(c),
+            'recall': float(r), 'false_accepts_per_hour': float(f),
+        }
+        for s, t, c, r, f in zip(sensitivity, trigger_level, cooldown, recall, fa_per_hour)
+    ]
+
+
+def recommend(points, max_fa_per_hour):
+    """Highest recall within the false accept budget, then fewer false accepts, then lower latency"""
+    allowed = [p for p in points if not p['false_accepts_per_hour'] > max_fa_per_hour] or points
+    return max(allowed, key=lambda p: (
+        np.nan_to_num(p['recall']), -np.nan_to_num(p['false_accepts_per_hour']), -p['trigger_level'], -p['cooldown']
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='WAV files or directories')
+    parser.add_argument('--models', help='Comma separated model names, defaults to every model in models/')
+    parser.add_argument('--max-fa-per-hour', type=float, default=0.5)
+    parser.add_argument('--cache-dir', default='.tune_cache')
+    parser.add_argument('--out', help='Write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    files = []
+    for path in find_wavs(args.paths):
+        data = read_wav(path)
+        if data:
+            files.append((path, label_of(path), data))
+    labels = [label for _, label, _ in files]
+    durations = [len(data) / 2 / RATE for _, _, data in files]
+
+    report = {}
+    for name in args.models.split(',') if args.models else list_models():
+        log.info(f'Tuning {name} on {len(files)} files')
+        points = sweep(cached_scores(name, files, args.cache_dir), labels, durations)
+        report[name] = {'recommended': recommend(points, args.max_fa_per_hour), 'points': points}
+
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
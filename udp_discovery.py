@@ -1,67 +1,143 @@
+import asyncio
+import random
 import socket
-import threading
 import time
 
+import netifaces
+
 import logger
+from config import config
 
 UDP_PORT = 8888
-BROADCAST_INTERVAL = 3  # seconds
+# Announce quickly after boot or a new peer, then back off to BROADCAST_INTERVAL
+BROADCAST_MIN_INTERVAL = 0.5  # seconds
+BROADCAST_INTERVAL = float(config.get('BROADCAST_INTERVAL', 30))  # seconds
+# Peers not heard from for this long are dropped
+PEER_TTL = float(config.get('PEER_TTL', 3 * BROADCAST_INTERVAL))  # seconds
+JITTER = 0.2
+# Devices on older firmware only parse `hello;<ip>` and fail on extra fields,
+# so the name goes out in a message of its own
+HELLO = 'hello'
+NAME = 'name'
 
-known_peers = set()
 log = logger.get(__name__)
 
 
+def get_own_address():
+    """
+    Returns the LAN IP and broadcast address from the interfaces, without any traffic.
+    The interface of the default route is preferred, so docker, libvirt or VPN
+    interfaces listed before it are not announced
+    """
+    default = netifaces.gateways().get('default', {}).get(netifaces.AF_INET)
+    interfaces = [default[1]] if default else netifaces.interfaces()
+    for interface in interfaces:
+        for address in netifaces.ifaddresses(interface).get(netifaces.AF_INET, []):
+            ip = address.get('addr', '')
+            if ip and not ip.startswith('127.'):
+                return ip, address.get('broadcast', '<broadcast>')
+    return '127.0.0.1', '<broadcast>'
+
+
 def get_own_ip():
-    # Best effort to get the LAN IP
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    try:
-        s.connect(("8.8.8.8", 80))
-        return s.getsockname()[0]
-    finally:
-        s.close()
+    return get_own_address()[0]
 
 
-my_ip = get_own_ip()
+class Discovery(asyncio.DatagramProtocol):
+    """
+    Announces this device and tracks peers on the LAN over one UDP socket.
 
+    Every announcement is a `hello;<ip>` followed by `name;<ip>;<name>`, a
+    `hello;<ip>;<name>` is accepted as well. A peer that comes back with a new
+    IP replaces its old entry, peers that stay silent for PEER_TTL expire.
+    `on_peer_found` and `on_peer_lost` are called with the peer IP.
+    """
 
-def udp_broadcast():
-    msg = f"hello;{my_ip}".encode("utf-8")
-    while True:
+    def __init__(self, name, on_peer_found, on_peer_lost=lambda ip: None):
+        self.name = name or ''
+        self.on_peer_found = on_peer_found
+        self.on_peer_lost = on_peer_lost
+        self.ip, self.broadcast = get_own_address()
+        self.peers = {}
+        self.transport = None
+        self.interval = BROADCAST_MIN_INTERVAL
+        self.wakeup = asyncio.Event()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            s.sendto(msg, ("<broadcast>", UDP_PORT))
-            s.close()
-        except Exception as e:
-            print(f"[broadcast] Error: {e}")
-        time.sleep(BROADCAST_INTERVAL)
-
-
-def udp_listener(loop, queue):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(("", UDP_PORT))
-    log.info(f"[listen] Listening on UDP port {UDP_PORT}")
-    while True:
+            parts = data.decode('utf-8').split(';')
+        except UnicodeDecodeError:
+            return
+        if parts[0] not in (HELLO, NAME) or len(parts) < (3 if parts[0] == NAME else 2):
+            return
+        peer_ip = parts[1]
+        if peer_ip == self.ip:
+            return
+        if len(parts) > 2:
+            peer_name = parts[2]
+        else:
+            # Named by its IP until its name message arrives
+            peer_name = self.peers[peer_ip][0] if peer_ip in self.peers else peer_ip
+
+        for ip, (name, _) in list(self.peers.items()):
+            if name == peer_name and ip != peer_ip:
+                self._lose(ip, 'moved')
+        if peer_ip not in self.peers:
+            log.info(f'[peer] Discovered: {peer_name} at {peer_ip}')
+            self.on_peer_found(peer_ip)
+            # Let the new peer learn about us without waiting for a slow announce
+            self.interval = BROADCAST_MIN_INTERVAL
+            self.wakeup.set()
+        self.peers[peer_ip] = (peer_name, time.monotonic())
+
+    def error_received(self, exc):
+        log.info(f'[discovery] Error: {exc}')
+
+    def _lose(self, ip, reason):
+        name, _ = self.peers.pop(ip)
+        log.info(f'[peer] Lost {name} at {ip} ({reason})')
+        self.on_peer_lost(ip)
+
+    async def announce(self):
+        messages = [f'{HELLO};{self.ip}'.encode('utf-8'), f'{NAME};{self.ip};{self.name}'.encode('utf-8')]
+        while True:
+            for message in messages:
+                self.transport.sendto(message, (self.broadcast, UDP_PORT))
+            self.wakeup.clear()
+            delay = self.interval * random.uniform(1 - JITTER, 1 + JITTER)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                self.interval = min(self.interval * 2, BROADCAST_INTERVAL)
+
+    async def expire(self):
+        while True:
+            await asyncio.sleep(max(PEER_TTL / 3, BROADCAST_MIN_INTERVAL))
+            now = time.monotonic()
+            for ip, (_, last_seen) in list(self.peers.items()):
+                if now - last_seen > PEER_TTL:
+                    self._lose(ip, 'expired')
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.bind(('', UDP_PORT))
+        await loop.create_datagram_endpoint(lambda: self, sock=sock)
+        log.info(f'[discovery] Running as {self.name} at {self.ip} on UDP port {UDP_PORT}')
         try:
-            data, addr = sock.recvfrom(1024)
-            msg = data.decode("utf-8")
-            if msg.startswith("hello;"):
-                _, peer_ip = msg.split(";")
-                if peer_ip != my_ip and peer_ip not in known_peers:
-                    known_peers.add(peer_ip)
-                    loop.call_soon_threadsafe(queue.put_nowait, peer_ip)
-                    log.info(f"[peer] Discovered: {peer_ip}")
-        except Exception as e:
-            log.info(f"[listen] Error: {e}")
+            await asyncio.gather(self.announce(), self.expire())
+        finally:
+            self.transport.close()
 
 
 if __name__ == "__main__":
-    log.info(f"[startup] Running as {my_ip}")
-    threading.Thread(target=udp_listener, daemon=True).start()
-    threading.Thread(target=udp_broadcast, daemon=True).start()
-
+    discovery = Discovery(config.get('NAME'), lambda ip: None)
     try:
-        while True:
-            time.sleep(1)
+        asyncio.run(discovery.run())
     except KeyboardInterrupt:
         log.info("\n[exit] Shutting down.")
@@ -2,10 +2,7 @@ import numpy as np
 
 
 # Provided by Alexander Veysov
-def int2float(sound):
-    abs_max = np.abs(sound).max()
-    sound = sound.astype('float32')
-    if abs_max > 0:
-        sound *= 1/32768
-    sound = sound.squeeze()  # depends on the use case
-    return sound
+def int2float(sound, out=None):
+    """Scales int16 samples to float32 in one pass, into `out` when given"""
+    sound = np.multiply(sound, np.float32(1 / 32768), out=out, dtype=np.float32)
+    return sound.squeeze()  # depends on the use case
@@ -0,0 +1,119 @@
+"""
+Bounded storage for the audio of one utterance.
+
+UtteranceBuffer preallocates room for UTTERANCE_MAX_MS of audio once and
+refuses to grow past it, the runner forces a FINISH when it fills up.
+With UTTERANCE_DEBUG_DIR set every utterance is also streamed to a WAV file
+there as it is heard, keeping the newest UTTERANCE_DEBUG_FILES files.
+"""
+import glob
+import os
+import time
+import wave
+from queue import SimpleQueue
+from threading import Thread
+
+import logger
+from config import config
+
+log = logger.get(__name__)
+
+# Longest utterance kept, listening is finished once it is reached
+UTTERANCE_MAX_MS = int(config.get('UTTERANCE_MAX_MS', 15000))
+UTTERANCE_DEBUG_DIR = config.get('UTTERANCE_DEBUG_DIR', '')
+UTTERANCE_DEBUG_FILES = int(config.get('UTTERANCE_DEBUG_FILES', 20))
+
+
+class WavSpill(object):
+    """
+    Streams utterances to rotating WAV files for debugging.
+    A writer thread does the file I/O, the capture thread only queues copies of the audio
+    """
+
+    def __init__(self, directory, max_files=UTTERANCE_DEBUG_FILES, rate=16000):
+        self.directory = directory
+        self.max_files = max_files
+        self.rate = rate
+        self.writing = False
+        # A path starts a file, bytes are appended to it, None closes it
+        self.queue = SimpleQueue()
+        os.makedirs(directory, exist_ok=True)
+        Thread(target=self._write_files, name='wav-spill', daemon=True).start()
+
+    def write(self, chunk):
+        if not self.writing:
+            self.writing = True
+            now = time.time()
+            name = time.strftime('utterance-%Y%m%d-%H%M%S', time.localtime(now)) + f'-{int(now * 1000) % 1000:03d}.wav'
+            self.queue.put(os.path.join(self.directory, name))
+        self.queue.put(bytes(chunk))
+
+    def close(self):
+        if self.writing:
+            self.writing = False
+            self.queue.put(None)
+
+    def _write_files(self):
+        file = None
+        while True:
+            item = self.queue.get()
+            try:
+                if isinstance(item, str):
+                    file = wave.open(item, 'wb')
+                    file.setnchannels(1)
+                    file.setsampwidth(2)
+                    file.setframerate(self.rate)
+                    self._rotate()
+                elif item is None:
+                    if file is not None:
+                        file.close()
+                    file = None
+                elif file is not None:
+                    # The header is patched on every write, so an interrupted file stays readable
+                    file.writeframes(item)
+            except OSError as e:
+                log.warning(f'Could not write the utterance WAV: {e}')
+                file = None
+
+    def _rotate(self):
+        paths = sorted(glob.glob(os.path.join(self.directory, 'utterance-*.wav')))
+        for path in paths[:max(len(paths) - self.max_files, 0)]:
+            os.remove(path)
+
+
+class UtteranceBuffer(object):
+    """
+    Preallocated buffer with the bytearray methods the runner uses.
+    extend() keeps what fits and returns False once the buffer is full
+    """
+
+    def __init__(self, max_ms=UTTERANCE_MAX_MS, debug_dir=UTTERANCE_DEBUG_DIR, rate=16000):
+        self.capacity = int(rate * max_ms / 1000) * 2
+        self._data = bytearray(self.capacity)
+        self._view = memoryview(self._data)
+        self._size = 0
+        self.spill = WavSpill(debug_dir, rate=rate) if debug_dir else None
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def full(self):
+        return self._size >= self.capacity
+
+    def extend(self, chunk):
+        n = min(len(chunk), self.capacity - self._size)
+        self._view[self._size:self._size + n] = memoryview(chunk).cast('B')[:n]
+        self._size += n
+        if self.spill and n:
+            self.spill.write(self._view[self._size - n:self._size])
+        return n == len(chunk)
+
+    def view(self):
+        """The audio so far, valid until clear()"""
+        return self._view[:self._size]
+
+    def clear(self):
+        self._size = 0
+        if self.spill:
+            self.spill.close()